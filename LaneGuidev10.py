@@ -9,16 +9,26 @@ import numpy as np
 import time
 from datetime import datetime
 import sys
-from picamera.array import PiRGBArray
-from picamera import PiCamera
+import undistort
+import message
+from camera_stream import CameraStream
+from maneuver import Maneuver
+from event_log import EventLog
+from lane_tracker import LaneTracker
+try:
+    from picamera import PiCamera
+except ImportError:                                 # not on the robot, frames come from somewhere else (e.g. a recording)
+    PiCamera = None
 
 global turn
 global delay
 
 
 # camera intialization global
-global initialized, camera
+global initialized, camera, stream
 initialized = False
+frame_seq = 0               # sequence number of the last frame processed from the camera stream
+frame_timeout = 1.0         # sec, longest wait for a new frame (shorter while a timed turn is running)
 
 # set initial state machine
 " State values modify which if statements the program runs through as it makes decisions"
@@ -29,7 +39,9 @@ fail_safe_count = 0         # state machine input
 start_count = 0             # state machine input
 count_time = time.time()    # timer
 nav_write = sys.stdout
-nav_msg_size = 50           # size of msg sent to arduino
+nav_seq = 0                 # sequence number of the last message sent to the driver
+last_command = None         # last command sent to the driver
+ring = None                 # frame_ring.FrameRing the frames and lane lines are published to, None to not publish
 
 right_int_count = 0         # counter input
 left_int_count = 0          # counter input
@@ -40,21 +52,52 @@ camera_init = 0             # counter input
 delay_90 = 6                # delay for L and R turns
 delay_180 = 12              # delay for turn around
 delay_0 = 0                 # delay for FWD
+turn_cancel_on_lanes = False    # end a timed turn early once both yellow lanes are back in view
+turn_min_time = 2               # sec, shortest turn that can be ended early
+
+# camera resolution. All pixel constants below are written for the 640 x 480 reference frame and are scaled by
+# scale_x/scale_y to the actual frame size, so the pipeline also runs at (320, 240) or (160, 120) for a faster mode
+camera_resolution = (640, 480)
+ref_width = 640             # width the pixel constants were tuned at
+ref_height = 480            # height the pixel constants were tuned at
+scale_x = 1.0               # frame width / ref_width, set by set_frame_size
+scale_y = 1.0               # frame height / ref_height, set by set_frame_size
+
+# undistortion
+undistort_top = 0.10        # top of the highest ROI (intersection_roi), rows above it are not undistorted
+
+# color segmentation boundaries (HSV)
+lower_yellow = np.array([10, 30, 130], dtype=int)       # lower HSV boundary for yellow lanes
+upper_yellow = np.array([40, 255, 255], dtype=int)      # upper HSV boundary for yellow lanes
+lower_purple = np.array([130, 85, 85], dtype=int)       # lower HSV boundary for purple intersections
+upper_purple = np.array([170, 255, 220], dtype=int)     # upper HSV boundary for purple intersections
+
+# lane tracking (smooths the lane lines between frames and limits the search to bands around them)
+lane_tracking = True
+lane_tracker = LaneTracker()
+
+# region of interest caches (ROIs only depend on the frame resolution)
+roi_vertices = {}           # (ROI name, rows, cols) -> polygon vertices
+roi_rects = {}              # polygon vertices -> (top, bottom, left, right), or None if not a rectangle
+roi_masks = {}              # (polygon vertices, image shape) -> mask for polygons that are not rectangles
 
 # create log file
 now = datetime.now()
-logfile = str("log") + str(now) + str(".txt")      # creates event log to track operation
+logfile = str("log") + str(now) + str(".jsonl")    # creates event log to track operation
+event_log = EventLog(logfile)                       # records are written by a background thread
 
 
-def nav(nav_write_input):                          # Interface with Driver software
-    global nav_write, camera, initialized
+def nav(nav_write_input, ring_input=None):         # Interface with Driver software
+    global nav_write, camera, stream, initialized, ring
     nav_write = nav_write_input
+    ring = ring_input
     
     # initialize the camera
     if not initialized:
         camera = PiCamera()
-        camera.resolution = (640, 480)              # use 640 x 480 resolution
+        camera.resolution = camera_resolution       # use 640 x 480 resolution (or a low resolution fast mode)
         camera.rotation = 180                       # rotate camera (mounted upside down)
+        stream = CameraStream(camera).start()       # capture continuously from the video port
         initialized = True
 
     # # Uncomment to disable nav with testing turret
@@ -63,18 +106,53 @@ def nav(nav_write_input):                          # Interface with Driver softw
 
 
 def msg(command):                                   # sends message to driver software
-    global nav_write
+    global nav_write, nav_seq, last_command
+    if command not in message.opcodes:              # not a driver command, drop it instead of crashing nav
+        print("Invalid command not sent: {}".format(command))
+        event_log.log("invalid_command", frame=frame_seq, command=command)
+        return
+    last_command = command
     if nav_write == sys.stdout:
         print(command)
     else:
-        nav_write.write(command.encode('utf-8'))
+        nav_seq += 1
+        nav_write.write(message.encode(command, nav_seq))
         nav_write.flush()
 
 
+def publish(frame, lines, frame_time):              # shares the frame and its lane lines (zero-copy for readers)
+    if ring is not None:
+        ring.publish(frame, last_command, nav_seq, lines, frame_time=frame_time, camera_seq=frame_seq)
+
+
+def log_maneuver(stats):                            # logs the summary of a timed turn
+    event_log.log("maneuver", frame=frame_seq, **stats)
+    lane_tracker.reset()                            # the lanes seen before the turn are gone
+
+
+# timed turns, the turn command is repeated by main() while frames keep being processed
+maneuver = Maneuver(msg, log_maneuver)
+
+
+def start_maneuver(command, duration, then=None):   # starts a timed turn, the lanes tracked so far are forgotten
+    lane_tracker.reset()
+    return maneuver.start(command, duration, then=then)
+
+
+def set_frame_size(frame):
+    """ Scale the pixel constants (tuned at ref_width x ref_height) to the size of the frame """
+    global scale_x, scale_y
+    rows, cols = frame.shape[:2]
+    scale_x = cols / ref_width
+    scale_y = rows / ref_height
+
+
 def lane_roi(frame):
     """Define a region of interest (polygon) for processing yellow lanes"""
     # Define Region of Interest (ROI)
     rows, cols = frame.shape[:2]
+    if ("lane", rows, cols) in roi_vertices:
+        return roi_vertices[("lane", rows, cols)]
     bottom_left = [cols * 0.00, rows * 1.00]        # bottom left corner of ROI
     mid_left = [cols * 0.00, rows * 0.7]            # mid left corner of ROI
     top_left = [cols * 0.0, rows * 0.20]            # top left corner of ROI
@@ -83,27 +161,73 @@ def lane_roi(frame):
     bottom_right = [cols * 1.00, rows * 1.00]       # bottom right corner of ROI
 
     lane_vertices = np.array([[bottom_left, mid_left, top_left, top_right, mid_right, bottom_right]], dtype=np.int32)
+    roi_vertices[("lane", rows, cols)] = lane_vertices
     return lane_vertices
 
 
-def process_lanes(frame, lane_vertices):
-    """ Process yellow lane lines using a series of open cv modules"""
-    mask = np.zeros_like(frame)
-    if len(mask.shape) == 2:
-        cv2.fillPoly(mask, lane_vertices, 255)      # create a mask in the shape of the ROI
-    else:
-        # In case the input image has a channel dimension
-        cv2.fillPoly(mask, lane_vertices, (255,) * mask.shape[2])
-
-    ROI = cv2.bitwise_and(frame, mask)              # crop the image to only show the ROI area
-
-    # Convert image to grayscale and HSV, and filter out colors that aren't yellow
-    grey = cv2.cvtColor(ROI, cv2.COLOR_BGR2GRAY)                            # convert to grey
-    processed_hsv = cv2.cvtColor(ROI, cv2.COLOR_BGR2HSV)                    # convert to HSV
-    lower_yellow = np.array([10, 30, 130], dtype=int)                       # lower HSV boundary for yellow
-    upper_yellow = np.array([40, 255, 255], dtype=int)                      # upper HSV boundary for yellow
+def roi_rect(vertices):
+    """ Return (top, bottom, left, right) if the ROI polygon is an axis-aligned rectangle, otherwise None """
+    key = vertices.tobytes()
+    if key not in roi_rects:
+        points = vertices.reshape(-1, 2)
+        left, top = points.min(axis=0)
+        right, bottom = points.max(axis=0)
+        # a polygon that fills its whole bounding box is that box
+        if cv2.contourArea(points) == (right - left) * (bottom - top):
+            roi_rects[key] = (int(top), int(bottom), int(left), int(right))
+        else:
+            roi_rects[key] = None
+    return roi_rects[key]
+
+
+def crop_roi(image, vertices):
+    """ Crop a single channel image to the ROI. Rectangular ROIs are returned as a (zero copy) slice of the image,
+    other polygons are masked with a mask cached per resolution. Also returns the (x, y) offset of the crop, which
+    must be added to any coordinates found in it """
+    rect = roi_rect(vertices)
+    if rect is not None:
+        top, bottom, left, right = rect
+        return image[top:bottom + 1, left:right + 1], (left, top)
+
+    key = (vertices.tobytes(), image.shape)
+    if key not in roi_masks:
+        mask = np.zeros_like(image)
+        cv2.fillPoly(mask, vertices, 255)           # create a mask in the shape of the ROI
+        roi_masks[key] = mask
+    return cv2.bitwise_and(image, roi_masks[key]), (0, 0)
+
+
+def segment_colors(frame):
+    """ Convert the frame to grey and HSV once and filter out the yellow (lane) and purple (intersection) colors.
+    Both process_lanes and process_intersection consume these images, so each frame is only converted once """
+    grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)                          # convert to grey
+    processed_hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)                  # convert to HSV
     mask_yellow = cv2.inRange(processed_hsv, lower_yellow, upper_yellow)    # yellow mask
-    processed = cv2.bitwise_and(grey, mask_yellow)                          # image with only yellow
+    mask_purple = cv2.inRange(processed_hsv, lower_purple, upper_purple)    # purple mask
+    yellow = cv2.bitwise_and(grey, mask_yellow)                             # image with only yellow
+    purple = cv2.bitwise_and(grey, mask_purple)                             # image with only purple
+    return yellow, purple
+
+
+def process_lanes(yellow, lane_vertices, lane_search=None):
+    """ Process yellow lane lines using a series of open cv modules. lane_search is None to search the whole ROI,
+    or the (rect, mask) from LaneTracker.search_bands to only search around the tracked lines"""
+    processed, lane_offset = crop_roi(yellow, lane_vertices)    # crop the image to only show the ROI area
+
+    band_mask = None
+    if lane_search is not None:
+        # crop further, to the part of the search bands inside the ROI
+        (top, bottom, left, right), band_mask = lane_search
+        x0, y0 = lane_offset
+        rows, cols = processed.shape[:2]
+        t, b = max(top - y0, 0), min(bottom - y0 + 1, rows)
+        l, r = max(left - x0, 0), min(right - x0 + 1, cols)
+        if b > t and r > l:
+            processed = processed[t:b, l:r]
+            band_mask = band_mask[t + y0 - top:b + y0 - top, l + x0 - left:r + x0 - left]
+            lane_offset = (x0 + l, y0 + t)
+        else:
+            band_mask = None
 
     # Smooth the Image for processing. Kernel size must be odd. Larger kernel size means more processing
     kernel_size = 3
@@ -115,78 +239,49 @@ def process_lanes(frame, lane_vertices):
     high_threshold = 150                # upper threshold for edge detection
 
     lane_edges = cv2.Canny(processed, low_threshold, high_threshold)        # lane edges image
-    return lane_edges
+    if band_mask is not None:
+        lane_edges = cv2.bitwise_and(lane_edges, band_mask)                 # only keep edges in the search bands
+    return lane_edges, lane_offset
+
 
+def average_lines(lines, selected):
+    """ Average the hough lines picked out by a boolean mask into one main line. Returns [] if none are picked """
+    if not selected.any():
+        return []
+    fit_avg = lines[selected].mean(axis=0)
+    return np.array([int(fit_avg[0]), int(fit_avg[1]), int(fit_avg[2]), int(fit_avg[3])])
 
-def create_lanes(lane_edges, frame):
+
+def create_lanes(lane_edges, frame, lane_offset=(0, 0)):
     """ Use hough line transform to create many lines which roughly map the edges we created earlier """
     global int_count
 
     # Hough Lines - Create lines over the lanes
     # these are important parameters for adjusting how it will create lines. Adjusting them can fix issues
-    lines = cv2.HoughLinesP(lane_edges, rho=1, theta=np.pi / 360, threshold=50, minLineLength=150, maxLineGap=100)
+    lines = cv2.HoughLinesP(lane_edges, rho=1, theta=np.pi / 360, threshold=max(int(50 * scale_x), 1),
+                            minLineLength=150 * scale_x, maxLineGap=100 * scale_x)
+    if lines is None:
+        return [], [], []
+
+    x0, y0 = lane_offset
+    lines = lines.reshape(-1, 4) + (x0, y0, x0, y0)                             # move lines back into frame coordinates
+    x1, y1, x2, y2 = lines.T
 
     # Create Main Lines by averaging all detected hough lines
-    # Bin main lines into three separate categories: left, right, center
-    line_image = np.zeros_like(frame)
+    # Bin main lines into three separate categories: left, right, center. All lines are binned at once
+    center = ((y2 - 50 * scale_y) < y1) & (y1 < (y2 + 50 * scale_y))            # center line category
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (y2 - y1) / (x2 - x1)                                           # vertical lines give +-inf
+    left = ~center & ((slope < -1/2) | ((slope <= 1/2) & (x1 < 300 * scale_x)))    # left lane category
+    right = ~center & ((slope > 1/2) | ((slope >= -1/2) & (x1 > 340 * scale_x)))   # right lane category
 
-    left_fit = []
-    right_fit = []
-    center_fit = []
-    if lines is not None:
-        for line in lines:
-            x1, y1, x2, y2 = line.reshape(4)
-            if (y2 - 50) < y1 < (y2 + 50):                                      # center line category
-                center_fit.append((x1, y1, x2, y2))                             # append center line directory
-                cv2.line(line_image, (x1, y1), (x2, y2), (0, 0, 255), 2)        # draw line on line image
-            else:
-                slope = (y2 - y1) / (x2 - x1)
-
-                if slope < -1/2:                                                # left lane category
-                    left_fit.append((x1, y1, x2, y2))
-                    cv2.line(line_image, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                elif slope > 1/2:                                               # right lane category
-                    right_fit.append((x1, y1, x2, y2))
-                    cv2.line(line_image, (x1, y1), (x2, y2), (255, 0, 0), 2)
-                elif x1 < 300:                                                  # left lane category
-                    left_fit.append((x1, y1, x2, y2))
-                    cv2.line(line_image, (x1, y1), (x2, y2), (0, 255, 0), 2)
-                elif x1 > 340:                                                  # right lane category
-                    right_fit.append((x1, y1, x2, y2))
-                    cv2.line(line_image, (x1, y1), (x2, y2), (255, 0, 0), 2)
-                else:                                                           # if it doesn't fit any of these pass
-                    pass
-
-    left_line, right_line, center_line = [], [], []
-    if len(left_fit) > 0:                                                       # average left lines
-        left_fit_avg = np.average(left_fit, axis=0)
-        x1 = int(left_fit_avg[0])
-        y1 = int(left_fit_avg[1])
-        x2 = int(left_fit_avg[2])
-        y2 = int(left_fit_avg[3])
-        left_line = [x1, y1, x2, y2]
-        left_line = np.array(left_line)
-
-    if len(right_fit) > 0:                                                      # average right lines
-        right_fit_avg = np.average(right_fit, axis=0)
-        x1 = int(right_fit_avg[0])
-        y1 = int(right_fit_avg[1])
-        x2 = int(right_fit_avg[2])
-        y2 = int(right_fit_avg[3])
-        right_line = [x1, y1, x2, y2]
-        right_line = np.array(right_line)
-
-    if len(center_fit) > 0:                                                     # average center lines
-        center_fit_avg = np.average(center_fit, axis=0)
-        x1 = int(center_fit_avg[0])
-        y1 = int(center_fit_avg[1])
-        x2 = int(center_fit_avg[2])
-        y2 = int(center_fit_avg[3])
-        center_line = [x1, y1, x2, y2]
-        center_line = np.array(center_line)
+    left_line = average_lines(lines, left)                                      # average left lines
+    right_line = average_lines(lines, right)                                    # average right lines
+    center_line = average_lines(lines, center)                                  # average center lines
 
     return right_line, left_line, center_line
 
+
 # this function draws lanes on the lane image - used in testing but not in final to save CPU
 def draw_lanes(frame, right_line, left_line, center_line, left_int, right_int, quad1_int, quad2_int, quad3_int,
                quad4_int):
@@ -250,48 +345,40 @@ def navigation(frame, center_line, right_line, left_line):
     nav_point_x = mid
 
 
-    with open(logfile, "a") as f:
-        print("C=", center_line, "L_l=", left_line, "R_l=", right_line, file=f)
+    event_log.log("lanes", frame=frame_seq, center=center_line, left=left_line, right=right_line)
 
     # if no intersections are visible and there is a right, left, and center lane command a turn around (dead end)
-    if state1 == 0 and len(center_line) > 0 and abs(center_line[0] - center_line[2]) > 20 and \
-            (int(center_line[1]) + int(center_line[3])) / 2 > 300 and len(right_line) > 0 and len(left_line) > 0:
-        with open(logfile, "a") as f:
-            print("Turn Around", file=f)
+    if state1 == 0 and len(center_line) > 0 and abs(center_line[0] - center_line[2]) > 20 * scale_x and \
+            (int(center_line[1]) + int(center_line[3])) / 2 > 300 * scale_y and len(right_line) > 0 and len(left_line) > 0:
+        event_log.log("turn_around", frame=frame_seq, turn=turn)
         delay = delay_180
-        start_turn = time.time()
-        while int(time.time() - start_turn) < delay:
-            command = turn
-            msg(command)
-    elif len(center_line) > 0 and abs(center_line[0] - center_line[2]) > 10 and \
-            (int(center_line[1]) + int(center_line[3])) / 2 > 380 \
-            and 200 < ((int(center_line[0]) + int(center_line[2])) /2) < 440:
+        start_maneuver(turn, delay)                     # main() repeats the turn until the delay is up
+        command = turn
+    elif len(center_line) > 0 and abs(center_line[0] - center_line[2]) > 10 * scale_x and \
+            (int(center_line[1]) + int(center_line[3])) / 2 > 380 * scale_y \
+            and 200 * scale_x < ((int(center_line[0]) + int(center_line[2])) /2) < 440 * scale_x:
         delay = delay_90
-        start_turn = time.time()
         if turn == "<LLL>" or turn == "<RRR>":
             pass
         else:
             turn = "<LLL>"
-        with open(logfile, "a") as f:
-            print("Yellow Line GO", turn, file=f)
-        while int(time.time() - start_turn) < delay:
-            command = turn
-            msg(command)
+        event_log.log("yellow_line_go", frame=frame_seq, turn=turn)
+        start_maneuver(turn, delay, then="<FWD>")       # main() repeats the turn until the delay is up, then FWD
+        command = turn
         state1 = 0                                      # reset states
         intersection_state = 0
         int_count = 0
         fail_safe_count = 0
         forward_count = 0
-        command = "<FWD>"
 
     # guidance decisions for most normal situations - may need to add later movement based on testing
     elif len(right_line) > 0 and len(left_line) > 0:
         left_x2 = left_line[2]
         right_x2 = right_line[0]
         nav_point_x = int((left_x2 + right_x2) / 2)
-        if left_line[0] > 250:
+        if left_line[0] > 250 * scale_x:
             command = "<LFT>"
-        elif right_line[2] < 390:
+        elif right_line[2] < 390 * scale_x:
             command = "<RGT>"
         elif nav_point_x > int(1.1 * mid):
             command = "<RRR>"
@@ -301,26 +388,25 @@ def navigation(frame, center_line, right_line, left_line):
             command = "<FWD>"
     elif len(right_line) > 0:
         right_x2 = right_line[0]
-        nav_point_x = int(right_x2 - 140)
+        nav_point_x = int(right_x2 - 140 * scale_x)
         if nav_point_x < int(mid):
             command = "<LLL>"
-        elif right_line[2] < 340:
+        elif right_line[2] < 340 * scale_x:
             command = "<RGT>"
         else:
             command = "<FWD>"
     elif len(left_line) > 0:
         left_x2 = left_line[2]
         left_x1 = left_line[0]
-        nav_point_x = int(left_x2 + 140)
+        nav_point_x = int(left_x2 + 140 * scale_x)
         if nav_point_x > int(mid):
             command = "<RRR>"
-        elif left_line[0] > 300:
+        elif left_line[0] > 300 * scale_x:
             command = "<LFT>"
         else:
             command = "<FWD>"
     else:
-        with open(logfile, "a") as f:
-            print("no lines detected - drive straight", file=f)
+        event_log.log("no_lines", frame=frame_seq, command="<FWD>")     # no lines detected - drive straight
         command = "<FWD>"
 
     return command
@@ -330,34 +416,22 @@ def intersection_roi(frame):
     """ Define Region of Interest (ROI) for the intersection """
     # currently the full screen, but can be adjusted to filter further
     rows, cols = frame.shape[:2]
+    if ("intersection", rows, cols) in roi_vertices:
+        return roi_vertices[("intersection", rows, cols)]
     bottom_left = [cols * 0.0, rows * 1]
     top_left = [cols * 0.0, rows * 0.1]
     bottom_right = [cols * 1, rows * 1]
     top_right = [cols * 1.0, rows * 0.1]
     intersection_vertices = np.array([[bottom_left, top_left, top_right, bottom_right]], dtype=np.int32)
+    roi_vertices[("intersection", rows, cols)] = intersection_vertices
     return intersection_vertices
 
 
-def process_intersection(frame, intersection_vertices):
+def process_intersection(purple, intersection_vertices):
     """ filter the region of interest (ROI) for the intersection using open cv modules"""
 
-    mask = np.zeros_like(frame)
-    if len(mask.shape) == 2:
-        cv2.fillPoly(mask, intersection_vertices, 255)
-    else:
-        # In case the input image has a channel dimension
-        cv2.fillPoly(mask, intersection_vertices, (255,) * mask.shape[2])
-
-    ROI = cv2.bitwise_and(frame, mask)
-
-    # process image
-    # Convert image to grayscale and HSV, and filter out colors that aren't purple"
-    gray = cv2.cvtColor(ROI, cv2.COLOR_BGR2GRAY)
-    processed_hsv = cv2.cvtColor(ROI, cv2.COLOR_BGR2HSV)
-    lower_purple = np.array([130, 85, 85], dtype=int)
-    upper_purple = np.array([170, 255, 220], dtype=int)
-    mask_purple = cv2.inRange(processed_hsv, lower_purple, upper_purple)
-    processed = cv2.bitwise_and(gray, mask_purple)
+    # crop the purple image (from segment_colors) to the ROI
+    processed, intersection_offset = crop_roi(purple, intersection_vertices)
 
     # smoothing
     kernel_size = 5
@@ -370,10 +444,10 @@ def process_intersection(frame, intersection_vertices):
 
     intersection_edges = cv2.Canny(processed, low_threshold, high_threshold)
 
-    return intersection_edges, processed
+    return intersection_edges, processed, intersection_offset
 
 
-def create_intersection(intersection_edges, frame):
+def create_intersection(intersection_edges, frame, intersection_offset=(0, 0)):
     """ Create intersections. The program bins intersections into right, left, and horizontal bins.
     Horizontal bins are further filtered into four quadrants from top to bottom. T
     his keeps the computer from trying to average two different horizontal lines into
@@ -388,113 +462,46 @@ def create_intersection(intersection_edges, frame):
     global count_time
 
     # Hough Lines for intersection
-    lines = cv2.HoughLinesP(intersection_edges, rho=1, theta=np.pi / 360, threshold=50, minLineLength=60, maxLineGap=70)
-    line_image = np.zeros_like(frame)
-
-    # Create Main Lines by averaging all detected hough lines for intersection
-    left_fit = []
-    right_fit = []
-    horizontal_fit = []
-    quad1 = []
-    quad2 = []
-    quad3 = []
-    quad4 = []
-    slope = []
+    lines = cv2.HoughLinesP(intersection_edges, rho=1, theta=np.pi / 360, threshold=max(int(50 * scale_x), 1),
+                            minLineLength=60 * scale_x, maxLineGap=70 * scale_x)
+
+    # Create Main Lines by averaging all detected hough lines for intersection. All lines are binned at once
     if lines is not None:
-        for line in lines:
-            x1, y1, x2, y2 = line.reshape(4)
-            if (x1 -5) < x2 < (x1 + 5):
-                slope = 0
-                pass
-            else:
-                slope = int((y2 - y1) / (x2 - x1))
-
-            if (y2 - 20) < y1 < (y2 + 20):
-                horizontal_fit.append((x1, y1, x2, y2))
-                # cv2.line(line_image, (x1, y1), (x2, y2), (255, 0, 255), 2)
-            elif slope < -1 / 2:
-                left_fit.append((x1, y1, x2, y2))
-                # cv2.line(line_image, (x1, y1), (x2, y2), (255, 255, 0), 2)
-
-            elif slope > 1 / 2:
-                right_fit.append((x1, y1, x2, y2))
-                # cv2.line(line_image, (x1, y1), (x2, y2), (0, 255, 255), 2)
-
-            else:
-                pass
-                # horizontal_fit.append((x1, y1, x2, y2))
-                # cv2.line(line_image, (x1, y1), (x2, y2), (255, 0, 255), 2)
+        x0, y0 = intersection_offset
+        segments = lines.reshape(-1, 4) + (x0, y0, x0, y0)     # move lines back into frame coordinates
+        x1, y1, x2, y2 = segments.T
+
+        # slopes are truncated to whole numbers, (near) vertical lines get a slope of 0
+        vertical = ((x1 - 5 * scale_x) < x2) & (x2 < (x1 + 5 * scale_x))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slopes = np.where(vertical, 0, np.trunc((y2 - y1) / (x2 - x1)))
+        slope = int(slopes[-1])
+
+        horizontal = ((y2 - 20 * scale_y) < y1) & (y1 < (y2 + 20 * scale_y))
+        left = ~horizontal & (slopes < -1 / 2)
+        right = ~horizontal & (slopes > 1 / 2)
+
+        # Average horizontal lines into four quadrants
+        y_avg = (y1 + y2) / 2
+        quad1 = horizontal & (0 < y_avg) & (y_avg <= 120 * scale_y)
+        quad2 = horizontal & (120 * scale_y < y_avg) & (y_avg <= 240 * scale_y)
+        quad3 = horizontal & (240 * scale_y < y_avg) & (y_avg <= 360 * scale_y)
+        quad4 = horizontal & ~(quad1 | quad2 | quad3)
     else:
-        pass
-    # Average horizontal lines into four quadrants
-    if len(horizontal_fit) > 0:
-        for [x1, y1, x2, y2] in horizontal_fit:
-            if 0 < ((int(y1)+int(y2))/2) <= 120:
-                quad1.append((x1, y1, x2, y2))
-            elif 120 < ((int(y1)+int(y2))/2) <= 240:
-                quad2.append((x1, y1, x2, y2))
-            elif 240 < ((int(y1)+int(y2))/2) <= 360:
-                quad3.append((x1, y1, x2, y2))
-            else:
-                quad4.append((x1, y1, x2, y2))
-
-    left_int, right_int, quad1_int, quad2_int, quad3_int, quad4_int = [], [], [], [], [], []
-
-    if len(left_fit) > 0:
-        left_fit_avg = np.average(left_fit, axis=0)
-        x1 = int(left_fit_avg[0])
-        y1 = int(left_fit_avg[1])
-        x2 = int(left_fit_avg[2])
-        y2 = int(left_fit_avg[3])
-        left_int = [x1, y1, x2, y2]
+        segments = np.zeros((0, 4), dtype=np.int32)
+        slope = []
+        left = right = quad1 = quad2 = quad3 = quad4 = np.zeros(0, dtype=bool)
+
+    left_int = np.array(average_lines(segments, left))
+    if left.any():
         left_int_count += 1
-    left_int = np.array(left_int)
-
-    if len(right_fit) > 0:
-        right_fit_avg = np.average(right_fit, axis=0)
-        x1 = int(right_fit_avg[0])
-        y1 = int(right_fit_avg[1])
-        x2 = int(right_fit_avg[2])
-        y2 = int(right_fit_avg[3])
-        right_int = [x1, y1, x2, y2]
+    right_int = np.array(average_lines(segments, right))
+    if right.any():
         right_int_count += 1
-    right_int = np.array(right_int)
-
-    if len(quad1) > 0:
-        quad1_avg = np.average(quad1, axis=0)
-        x1 = int(quad1_avg[0])
-        y1 = int(quad1_avg[1])
-        x2 = int(quad1_avg[2])
-        y2 = int(quad1_avg[3])
-        quad1_int = [x1, y1, x2, y2]
-    quad1_int = np.array(quad1_int)
-
-    if len(quad2) > 0:
-        quad2_avg = np.average(quad2, axis=0)
-        x1 = int(quad2_avg[0])
-        y1 = int(quad2_avg[1])
-        x2 = int(quad2_avg[2])
-        y2 = int(quad2_avg[3])
-        quad2_int = [x1, y1, x2, y2]
-    quad2_int = np.array(quad2_int)
-
-    if len(quad3) > 0:
-        quad3_avg = np.average(quad3, axis=0)
-        x1 = int(quad3_avg[0])
-        y1 = int(quad3_avg[1])
-        x2 = int(quad3_avg[2])
-        y2 = int(quad3_avg[3])
-        quad3_int = [x1, y1, x2, y2]
-    quad3_int = np.array(quad3_int)
-
-    if len(quad4) > 0:
-        quad4_avg = np.average(quad4, axis=0)
-        x1 = int(quad4_avg[0])
-        y1 = int(quad4_avg[1])
-        x2 = int(quad4_avg[2])
-        y2 = int(quad4_avg[3])
-        quad4_int = [x1, y1, x2, y2]
-    quad4_int = np.array(quad4_int)
+    quad1_int = np.array(average_lines(segments, quad1))
+    quad2_int = np.array(average_lines(segments, quad2))
+    quad3_int = np.array(average_lines(segments, quad3))
+    quad4_int = np.array(average_lines(segments, quad4))
 
     """ state modifier"""
     # state1 == 1 when the camera detects intersection lines and the bottom of those lines is low enough in the field
@@ -508,40 +515,36 @@ def create_intersection(intersection_edges, frame):
     # after counting two lines, the robot is approximately in the center of the intersection,
     # intersection_state == 2....the robot sends a command to go left, straight, or right and resets all states to zero
 
-    with open(logfile, "a") as f:
-        print("L:", left_int, "R:", right_int, "q1", quad1_int, "q2", quad2_int,"q3:",
-              quad3_int, "q4:", quad4_int, file=f)
+    event_log.log("intersection", frame=frame_seq, left=left_int, right=right_int, quad1=quad1_int, quad2=quad2_int,
+                  quad3=quad3_int, quad4=quad4_int)
 
     if state1 == 2:
         if forward_count > 6:
             intersection_state = 2
     elif lines is not None:
-        if len(left_int) > 0 and 220 < left_int[1] < 300:
+        if len(left_int) > 0 and 220 * scale_y < left_int[1] < 300 * scale_y:
             state1 = 1
-        elif len(right_int) > 0 and 220 < right_int[3] < 300:
+        elif len(right_int) > 0 and 220 * scale_y < right_int[3] < 300 * scale_y:
             state1 = 1
         # elif len(quad3_int) > 0 and 240 < quad3_int[1] < 300:
             # state1 = 1
 
     # Count the number of horizontal intersection lines that pass through the detection lane at the bottom of the screen
     # by adding 1 to the int count
-    detection_lane = 300
+    detection_lane = 300 * scale_y
     if state1 == 2:
         if len(quad3_int) > 0:
             avg_y = (int(quad3_int[1]) + int(quad3_int[3]))/2
             AbsDistance = abs(avg_y - detection_lane)
             if intersection_state == 1 or state1 == 1:
-                if AbsDistance <= 60 and avg_y > detection_lane:
+                if AbsDistance <= 60 * scale_y and avg_y > detection_lane:
                     int_count += 1
-                    with open(logfile, "a") as f:
-                        print("purple counted", file =f)
+                    event_log.log("purple_counted", frame=frame_seq, int_count=int_count)
         elif len(quad4_int) > 0:
             if intersection_state == 1 or state1 == 1:
                 int_count += 1
-                with open(logfile, "a") as f:
-                    print("purple counted", file=f)
-        with open(logfile, "a") as f:
-            print("intersection counter is ON!", file = f)
+                event_log.log("purple_counted", frame=frame_seq, int_count=int_count)
+        event_log.log("intersection_counter_on", frame=frame_seq)
 
     return slope, left_int, right_int, quad1_int, quad2_int, quad3_int, quad4_int
 
@@ -557,17 +560,17 @@ def guidance_decision(left_int, right_int, quad1_int, quad2_int, quad3_int, quad
     global delay_90
     global delay_0
 
-    if len(right_int) > 0 and right_int[1] < 360:
+    if len(right_int) > 0 and right_int[1] < 360 * scale_y:
         turn = "<RRR>"
         delay = delay_90
         intersection_state = 1
-    elif (len(quad1_int) > 0 and len(quad2_int) > 0 and (abs(quad2_int[1] - quad1_int[1]) > 50)) or \
-            (len(quad2_int) > 0 and len(quad3_int) > 0 and (abs(quad2_int[1] - quad3_int[1]) > 50)) or \
+    elif (len(quad1_int) > 0 and len(quad2_int) > 0 and (abs(quad2_int[1] - quad1_int[1]) > 50 * scale_y)) or \
+            (len(quad2_int) > 0 and len(quad3_int) > 0 and (abs(quad2_int[1] - quad3_int[1]) > 50 * scale_y)) or \
             (len(quad3_int) > 0 and len(quad1_int) > 0) or (len(quad2_int) > 0 and len(quad4_int) > 0):
         turn = "<FWD>"
         delay = delay_0
         intersection_state = 1
-    elif len(left_int) > 0 and left_int[3] < 360:
+    elif len(left_int) > 0 and left_int[3] < 360 * scale_y:
         turn = "<LLL>"
         delay = delay_90
         intersection_state = 1
@@ -578,7 +581,7 @@ def guidance_decision(left_int, right_int, quad1_int, quad2_int, quad3_int, quad
             intersection_state = 1
             start_count += 1
         else:
-            turn = "LLL"
+            turn = "<LLL>"
             delay = delay_90
             intersection_state = 1
     else:
@@ -586,53 +589,73 @@ def guidance_decision(left_int, right_int, quad1_int, quad2_int, quad3_int, quad
         intersection_state = 0
         int_count = 0
         turn = "<FWD>"
-        with open(logfile, "a") as f:
-            print("guidance decisions aren't working", turn, file=f)
+        event_log.log("guidance_failed", frame=frame_seq, turn=turn)      # guidance decisions aren't working
         delay = delay_0
 
     # for testing
-    with open(logfile, "a") as f:
-        print("guidance decision is:", turn, file=f)
+    event_log.log("guidance_decision", frame=frame_seq, turn=turn)
 
 
 def main():
     global state1
     global intersection_state
     global int_count
-    global logfile
     global fail_safe_count
-    global camera
+    global stream
+    global frame_seq
     global start_count
     global forward_count
 
-    # camera distortion corrections
-    k = np.array([[243.48186479, 0., 305.08168044],
-                  [0., 244.0802712, 226.73721762],
-                  [0., 0., 1.]])
-
-    d = np.array([-2.67227451e-01, 6.92939876e-02, 2.32058609e-03, 2.62454856e-05, -7.75020091e-03])
-    
-    # grab a reference to the raw camera capture
-    rawCapture = PiRGBArray(camera, size=(640, 480))
-    camera.capture(rawCapture, format="bgr")
-
-    # convert to numpy array for use by cv2
-    raw_frame = rawCapture.array
-
-    # un-distort image
+    # get the newest frame from the camera stream (older frames that were never processed are dropped). During
+    # a timed turn, wait no longer than until the turn command is due again
+    timeout = frame_timeout
+    if maneuver.active():
+        timeout = min(timeout, maneuver.wait_time())
+    raw_frame, frame_time, frame_seq = stream.read(after_seq=frame_seq, timeout=timeout)
+    if raw_frame is None:
+        if not stream.running():                    # capture thread died - stop instead of driving blind
+            print("Camera stream stopped: {}".format(stream.error))
+            event_log.log("camera_stopped", frame=frame_seq, error=repr(stream.error))
+            msg("<STP>")
+            raise RuntimeError("camera stream stopped: {}".format(stream.error))
+        maneuver.update()                           # no frame yet, keep a running turn alive
+        return
+
+    # while a timed turn is running only keep its command alive, the lanes are only needed to end it early
+    if maneuver.active() and not turn_cancel_on_lanes:
+        maneuver.update()
+        publish(raw_frame, (), frame_time)
+        return
+
+    # un-distort image (maps are cached by the undistort module, only ROI rows are remapped)
     h, w = raw_frame.shape[:2]
-    new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(k, d, (w, h), 0)
-    map_x, map_y = cv2.initUndistortRectifyMap(k, d, None, new_camera_matrix, (w, h), 5)
-
-    frame = cv2.remap(raw_frame, map_x, map_y, cv2.INTER_LINEAR)
+    frame = undistort.undistort(raw_frame, first_row=int(h * undistort_top))
+    set_frame_size(frame)
 
+    yellow, purple = segment_colors(frame)
     lane_vertices = lane_roi(frame)
-    lane_edges = process_lanes(frame, lane_vertices)
-    right_line, left_line, center_line = create_lanes(lane_edges, frame)
+    lane_search = lane_tracker.search_bands(frame.shape, scale_x) if lane_tracking else None
+    lane_edges, lane_offset = process_lanes(yellow, lane_vertices, lane_search)
+    right_line, left_line, center_line = create_lanes(lane_edges, frame, lane_offset)
+    if lane_tracking:
+        right_line, left_line, center_line = lane_tracker.update(right_line, left_line, center_line, frame_seq,
+                                                                 scale_x)
+
+    # with turn_cancel_on_lanes, watch for the lanes to come back during a timed turn
+    if maneuver.active():
+        if turn_cancel_on_lanes and maneuver.elapsed() > turn_min_time and len(right_line) > 0 \
+                and len(left_line) > 0:
+            maneuver.cancel()
+        else:
+            maneuver.update()
+            publish(frame, (right_line, left_line, center_line), frame_time)
+            return
+
     intersection_vertices = intersection_roi(frame)
-    intersection_edges, processed = process_intersection(frame, intersection_vertices)
+    intersection_edges, processed, intersection_offset = process_intersection(purple, intersection_vertices)
     slope, left_int, right_int, quad1_int, quad2_int, quad3_int, quad4_int = create_intersection(intersection_edges,
-                                                                                                 frame)
+                                                                                                 frame,
+                                                                                                 intersection_offset)
     # lane_image = draw_lanes(frame, right_line, left_line, center_line, left_int, right_int, quad1_int, quad2_int,
                             # quad3_int, quad4_int)
     if state1 == 1:
@@ -653,18 +676,13 @@ def main():
         if int_count > 0:
             if command == "<FWD>":
                 forward_count += 1
-        with open(logfile, "a") as q:
-            print("drive", command, file=q)
-            print("int count is:", int_count, file=q)
+        event_log.log("drive", frame=frame_seq, command=command, int_count=int_count)
     elif intersection_state == 2:
         # execute decision and reset all states
-        start_turn = time.time()
-        while int(time.time() - start_turn) < delay:
-            command = turn
-            msg(command)
-        with open(logfile, "a") as q:
-            print("Go", turn, file=q)
-        # pause execution of decisions until turn has been completed
+        if start_maneuver(turn, delay):                 # main() repeats the turn until the delay is up
+            msg(turn)
+        event_log.log("go", frame=frame_seq, turn=turn)
+        # decisions are paused (at the top of main) until the turn has been completed
 
         state1 = 0
         intersection_state = 0
@@ -673,16 +691,14 @@ def main():
         start_count += 1
         forward_count = 0
 
-    with open(logfile, "a") as q:
-        print("intersection_state=", intersection_state, "state1=", state1, "int count=", int_count, file=q)
+    event_log.log("state", frame=frame_seq, intersection_state=intersection_state, state1=state1,
+                  int_count=int_count)
+    publish(frame, (right_line, left_line, center_line), frame_time)
     # show_test(lane_image)
 
     key_pressed = cv2.waitKey(1) & 0xFF          # Delay for key press to quit and frame rate (1 ms)
     if key_pressed == ord('q'):
 
-        # clear the stream in preparation for the next frame
-        rawCapture.truncate(0)
-
         # cleanup
         cv2.destroyAllWindows()
 
@@ -690,5 +706,3 @@ def main():
 if __name__=="__main__":
     while True:
         nav(sys.stdout)
-
-cv2.waitKey()
@@ -14,7 +14,6 @@ import luxonis_resources.depthai as depthai
 from luxonis_resources import utils
 
 import os
-import json
 from os import path
 from pathlib import Path
 
@@ -34,12 +33,18 @@ blob_file          = relative_to_abs_path('luxonis_resources/mobilenet_ssd.blob'
 # INIT
 # --------------------------
 
-def camera_init():
+def camera_init(depth=False):
     calc_dist_to_bb = False
-    streams = json.loads('{"streams": [{"name": "previewout", "max_fps": 12.0}]}')
+    # metaout carries the MobileNet-SSD detections and depth_sipp the stereo
+    # depth (uint16, mm) used by targeting.py. depth_sipp is only streamed when
+    # depth is true (targeting.depth_gating), it costs USB bandwidth and frame rate
+    streams = [{"name": "previewout", "max_fps": 12.0}, {"name": "metaout"}]
+    if depth:
+        streams.append({"name": "depth_sipp", "max_fps": 12.0})
+    streams = {"streams": streams}
 
     default_config = {
-        'streams': ['previewout'],
+        'streams': [stream["name"] for stream in streams["streams"]],
         'depth': {
             'calibration_file': '',
             'padding_factor': 0.3
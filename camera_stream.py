@@ -0,0 +1,98 @@
+# File:        camera_stream.py
+# Platform:    Rasbian Buster with Python3
+# Description: Continuous video port capture for the Raspberry Pi camera
+#
+# Capturing a still (camera.capture on the still port) every frame is slow.
+# CameraStream runs a background thread that captures from the video port into
+# a small ring of reused PiRGBArray buffers and keeps only the newest frame.
+# Readers get that frame with its capture time and sequence number, so the
+# navigation loop never waits on the sensor and frames it is too slow for are
+# dropped instead of queued.
+
+import time
+import threading
+
+try:
+    from picamera.array import PiRGBArray
+except ImportError:     # not on the robot
+    PiRGBArray = None
+
+
+class CameraStream(object):
+
+    def __init__(self, camera, size=None, buffers=3):
+        self.camera = camera
+        self.size = size if size is not None else tuple(camera.resolution)
+        self.ring = [PiRGBArray(camera, size=self.size) for _ in range(buffers)]
+
+        self.frame = None           # newest frame (numpy array, BGR)
+        self.timestamp = 0          # time.monotonic() when the newest frame was captured
+        self.seq = 0                # sequence number of the newest frame, 0 = no frame yet
+        self.dropped = 0            # frames that were replaced before anyone read them
+        self.error = None           # exception that stopped the capture thread, if any
+
+        self._read_seq = 0
+        self._running = False
+        self._thread = None
+        self._new_frame = threading.Condition()
+
+    def start(self):
+        """ Start capturing in the background """
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._capture, name="camera_stream")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop capturing and wait for the capture thread to finish """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def running(self):
+        return self._running
+
+    def read(self, after_seq=None, timeout=1.0):
+        """ Return (frame, timestamp, seq) for the newest frame. If after_seq is given, wait (up to timeout seconds)
+        for a frame newer than that one so the same frame is not processed twice. frame is None if nothing arrived """
+        with self._new_frame:
+            if after_seq is not None and self.seq <= after_seq:
+                self._new_frame.wait_for(lambda: self.seq > after_seq or not self._running, timeout)
+            if after_seq is not None and self.seq <= after_seq:
+                return None, self.timestamp, self.seq
+            self._read_seq = self.seq
+            return self.frame, self.timestamp, self.seq
+
+    def _buffers(self):
+        # capture_sequence asks for the next output once the previous one holds a complete frame, so each buffer
+        # is published just before it is handed out again
+        i = 0
+        while self._running:
+            buf = self.ring[i]
+            buf.truncate(0)
+            yield buf
+            self._publish(buf.array)
+            i = (i + 1) % len(self.ring)
+
+    def _publish(self, frame):
+        with self._new_frame:
+            if self.seq > self._read_seq:
+                self.dropped += 1
+            self.frame = frame
+            self.timestamp = time.monotonic()
+            self.seq += 1
+            self._new_frame.notify_all()
+
+    def _capture(self):
+        try:
+            self.camera.capture_sequence(self._buffers(), format="bgr", use_video_port=True)
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            with self._new_frame:
+                self._running = False
+                self._new_frame.notify_all()
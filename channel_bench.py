@@ -0,0 +1,116 @@
+# File:        channel_bench.py
+# Platform:    Python3 (dev box or Rasbian Buster)
+# Description: Catch-up time after a flood of driver messages
+#
+# A forked writer floods an os.pipe with commands (one every --period ms, like
+# a fast targeting loop) while the reader is busy for --busy seconds, as the
+# driver is during a long turn. The pipe fills and the writer blocks. When the
+# reader resumes, catch-up time is how long it takes until it handles a fresh
+# message (under 10 ms old). Handling a message costs --handle ms, like
+# forwarding it to the Arduino. Compares reading every queued message
+# (message.Reader, dropping those older than driver.max_msg_age) with a
+# message.Channel that is coalesced when the reader resumes (the driver
+# switching state), which keeps only the newest message of the backlog, and
+# then read in order.
+#
+# usage:
+#     channel_bench.py [--busy 2.0] [--period 1.0] [--handle 1.0]
+
+import os
+import time
+import argparse
+
+import message
+
+max_msg_age = 0.5       # sec, same as driver.max_msg_age
+fresh_age = 0.010       # sec, a message younger than this counts as caught up
+flood_after = 5.0       # sec, the writer keeps sending this long after the reader resumes
+
+
+def writer(fd, duration, period):
+    f = os.fdopen(fd, 'wb', closefd=False)
+    end = time.monotonic() + duration
+    seq = 0
+    while time.monotonic() < end:
+        f.write(message.encode("<LFT>", seq))
+        f.flush()       # blocks while the pipe is full
+        seq += 1
+        time.sleep(period)
+
+
+def read_queued(fd, handle):
+    """ Every queued message in order. Returns (caught up, handled, skipped) before a fresh one """
+    reader = message.Reader(fd)
+    handled = skipped = 0
+    while True:
+        msg = reader.read()
+        if msg is None:     # the writer finished first, never caught up
+            return None, handled, skipped
+        age = message.age(msg)
+        if age < fresh_age:
+            return True, handled, skipped
+        if age > max_msg_age:
+            skipped += 1
+            continue
+        time.sleep(handle)
+        handled += 1
+
+
+def read_coalesced(fd, handle):
+    """ Backlog coalesced, then in order. Returns (caught up, handled, dropped) before a fresh one """
+    channel = message.Channel(fd)
+    channel.coalesce()      # the driver switched state
+    handled = 0
+    while True:
+        channel.fill()
+        msg = channel.pop()
+        if msg is None and channel.closed:
+            return None, handled, channel.dropped
+        if msg is None:
+            time.sleep(0.0005)  # the driver would wait in select()
+            continue
+        age = message.age(msg)
+        if age < fresh_age:
+            return True, handled, channel.dropped
+        if age > max_msg_age:
+            continue
+        time.sleep(handle)
+        handled += 1
+
+
+def run(reader, busy, period, handle):
+    """ Returns (catch-up seconds or None, stale messages handled, messages skipped) """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        writer(w, busy + flood_after, period)
+        os._exit(0)
+    os.close(w)
+    time.sleep(busy)
+    start = time.monotonic()
+    caught_up, handled, skipped = reader(r, handle)
+    elapsed = time.monotonic() - start if caught_up else None
+    os.close(r)             # the writer gets EPIPE and exits
+    os.kill(pid, 9)
+    os.waitpid(pid, 0)
+    return elapsed, handled, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Catch-up time after a flood of driver messages")
+    parser.add_argument("--busy", type=float, default=2.0, help="sec the reader is busy while the pipe floods")
+    parser.add_argument("--period", type=float, default=1.0, help="ms between messages from the writer")
+    parser.add_argument("--handle", type=float, default=1.0, help="ms to handle (forward) one message")
+    args = parser.parse_args()
+
+    print("busy {} s, a message every {} ms, {} ms to handle one".format(args.busy, args.period, args.handle))
+    for name, reader in [("queued (Reader)", read_queued), ("coalesced (Channel)", read_coalesced)]:
+        elapsed, handled, skipped = run(reader, args.busy, args.period / 1e3, args.handle / 1e3)
+        caught_up = "caught up in {:8.1f} ms".format(1e3 * elapsed) if elapsed is not None else \
+            "not caught up in {:.0f} s".format(flood_after)
+        print("{:>19}: {}, {:5d} stale messages handled, {:5d} dropped".format(name, caught_up, handled, skipped))
+
+
+if __name__ == "__main__":
+    main()
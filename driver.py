@@ -9,14 +9,23 @@
 import os
 import sys
 import time
+import atexit
 import serial
-from datetime import datetime
+import asyncio
 
-from LaneGuidev10 import nav, nav_msg_size
-from targeting import target, target_msg_size
+import message
+import driver_io
+from latency import LatencyHistogram
+from LaneGuidev10 import nav, camera_resolution
+import targeting
+from targeting import target
 
 import luxonis_resources.depthai as depthai
 from camera_init import camera_init
+try:
+    import frame_ring
+except ImportError: # multiprocessing.shared_memory needs Python 3.8
+    frame_ring = None
 
 # states
 initializing = 0
@@ -26,10 +35,28 @@ shooting = 3
 state = initializing
 
 # file objects for reading/writing
-mtr_write = None
-tur_write = None
+mtr_write = None    # driver_io.Port on the motor Arduino (sys.stdout when testing)
+tur_write = None    # driver_io.Port on the turret Arduino (sys.stdout when testing)
 nav_read = None
 target_read = None
+nav_msgs = None     # message.Channel on nav_read
+target_msgs = None  # message.Channel on target_read
+max_msg_age = 0.5   # sec, older messages are dropped
+
+# event loop (asyncio)
+state_changed = None # asyncio.Event, set when a message is handled or the state changes
+state_sources = {turning: "nav", shooting: "target"} # state -> module whose messages keep it going
+state_timeout = 5.0 # sec, a turn or engagement ends if its module sends nothing for this long
+last_handled = {"nav": 0, "target": 0} # time, when a message from the module was last handled
+latency = {"nav": LatencyHistogram("nav"), "target": LatencyHistogram("target")} # message age when handled
+report_every = 10   # sec, how often the latency histograms are printed
+
+# shared memory rings the nav and targeting processes publish their frames
+# and results to (see frame_ring.py), observers attach to them by name
+rings = {}          # source -> frame_ring.FrameRing
+ring_shapes = {"nav": (camera_resolution[1], camera_resolution[0], 3), # undistorted PiCamera frame
+               "target": (300, 300, 3)}                              # Luxonis previewout
+ring_prefix = "clade_" # the rings are named ring_prefix + source
 
 # Arduino comms variables
 arduino_port_tur = "/dev/ttyACM0"
@@ -41,48 +68,65 @@ arduino_baudrate_mtr = 9600
 testing_pi_driver = False
 
 def driver():
-    while True:
-        if state == initializing:
-            init()
-        elif state == looking:
-            look()
-        elif state == turning:
-            turn()
-        elif state == shooting:
-            shoot()
-        else:
-            break # something went wrong
+    init()
+    asyncio.run(run())
+
+
+async def run():
+    global state_changed
+    state_changed = asyncio.Event()
+
+    # handle whichever source is ready (navigation, targeting or an Arduino),
+    # so a quiet source never holds up the others. Between messages the
+    # process sleeps in the event loop (epoll on Linux)
+    tasks = [asyncio.ensure_future(state_machine()), asyncio.ensure_future(report_loop())]
+    if not testing_pi_driver:
+        tasks.append(asyncio.ensure_future(read_port(mtr_write, "motor")))
+        tasks.append(asyncio.ensure_future(read_port(tur_write, "turret")))
+
+    # run until both modules have closed their pipes
+    await asyncio.gather(handle_msgs(driver_io.MessageStream(nav_msgs), "nav", process_nav_msg, shooting),
+                         handle_msgs(driver_io.MessageStream(target_msgs), "target", process_target_msg, turning))
+    for task in tasks:
+        task.cancel()
 
 
 def init():
-    global state, nav_read, target_read, mtr_write, tur_write
+    global state, nav_read, target_read, nav_msgs, target_msgs, mtr_write, tur_write
 
     # Fork the driver process into 3 separate processes, 
     # 2 child processes running targeting and nav, and 
     # one parent process handing hardware comms
 
+    # frame rings, created before the fork so the children share them
+    if frame_ring is not None:
+        for source, shape in ring_shapes.items():
+            rings[source] = frame_ring.FrameRing.create(ring_prefix + source, shape)
+
     # navigation pipe
     r, w = os.pipe()
     pid = os.fork()
     if pid == 0: # child
         os.close(r)
-        nav_write = os.fdopen(w, 'w')
-        nav(nav_write) # run the navigation
+        nav_write = os.fdopen(w, 'wb')
+        nav(nav_write, rings.get("nav")) # run the navigation
         sys.exit(0)
     os.close(w)
-    nav_read = os.fdopen(r)
+    nav_read = os.fdopen(r, 'rb')
+    nav_msgs = message.Channel(nav_read)
     
     # targeting pipe
     r, w = os.pipe()
     pid = os.fork()
     if pid == 0: # child
         os.close(r)
-        target_write = os.fdopen(w, 'w')
-        pipeline = camera_init()
-        target(target_write, pipeline) # run the targeting
+        target_write = os.fdopen(w, 'wb')
+        pipeline = camera_init(targeting.depth_gating)
+        target(target_write, pipeline, rings.get("target")) # run the targeting
         sys.exit(0)
     os.close(w)
-    target_read = os.fdopen(r)
+    target_read = os.fdopen(r, 'rb')
+    target_msgs = message.Channel(target_read)
     
     # open serial to Arduino (or stdout for testing)
     if testing_pi_driver:
@@ -90,41 +134,62 @@ def init():
         tur_write = sys.stdout
         print("test output")
     else:
-        tur_write = serial.Serial(port=arduino_port_tur, baudrate=arduino_baudrate_tur)
-        mtr_write = serial.Serial(port=arduino_port_mtr, baudrate=arduino_baudrate_mtr)
+        tur_write = driver_io.Port(serial.Serial(port=arduino_port_tur, baudrate=arduino_baudrate_tur))
+        mtr_write = driver_io.Port(serial.Serial(port=arduino_port_mtr, baudrate=arduino_baudrate_mtr))
         print("HW output")
 
+    atexit.register(close_rings) # runs after report_latency (last registered runs first)
+    atexit.register(report_latency)
+
     # change state
     state = looking
 
 
-def look():
-    process_msg(nav_read, nav_msg_size, process_nav_msg)
-    process_msg(target_read, target_msg_size, process_target_msg)
+async def state_machine():
+    # a turn (or an engagement) lasts as long as navigation (or targeting)
+    # keeps sending. If the module goes quiet, e.g. because it crashed, the
+    # driver goes back to looking instead of ignoring the other module forever
+    global state
+    while True:
+        state_changed.clear()
+        source = state_sources.get(state)
+        timeout = None if source is None else last_handled[source] + state_timeout - time.monotonic()
+        try:
+            await asyncio.wait_for(state_changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            print("No {} messages for {} s, back to looking".format(source, state_timeout))
+            state = looking
+            state_switched(None)
 
 
-def turn(): # if turning, ignore targeting commands
-    process_msg(nav_read, nav_msg_size, process_nav_msg)
-    target_read.flush()
+async def read_port(port, name):
+    # print whatever the Arduino sends, so its buffer does not fill up
+    line = await port.readline()
+    while line:
+        print("{}: {}".format(name, line.decode('utf-8', 'replace').strip()))
+        line = await port.readline()
 
 
-def shoot(): # if shooting, ignore navigation commands
-    nav_read.flush()
-    process_msg(target_read, target_msg_size, process_target_msg)
+async def report_loop():
+    while True:
+        await asyncio.sleep(report_every)
+        report_latency()
 
 
 def send_msg_mtr(msg):
     # forward message to the Arduino (without timestamp)
-    mtr_write.write(msg.encode('utf-8'))
     if mtr_write == sys.stdout:
-        print("")
+        print(msg)
+    else:
+        mtr_write.write(msg.encode('utf-8'))
 
 
 def send_msg_tur(msg):
     # forward message to the Arduino (without timestamp)
-    tur_write.write(msg.encode('utf-8'))
     if tur_write == sys.stdout:
-        print("")
+        print(msg)
+    else:
+        tur_write.write(msg.encode('utf-8'))
 
 
 def process_nav_msg(command):
@@ -173,28 +238,72 @@ def process_target_msg(command):
     send_msg_tur(command)
 
 
-def process_msg(read, msg_size, process_fcn):
-    # read messages without trailing whitespace
-    msg = (read.read(msg_size)).strip()
-    
-    # get the message receive time
-    received = float(datetime.now().strftime('%S.%f'))
-    
-    # split message by words and get the sent time
-    words = msg.split()
-    sent = float(words[-1])
-    
-    # if delay between sending and receiving is greater than 0.5s, assume that
-    #    the received messages will be old and clear the input buffer
-    dt = received - sent
-    if dt > 0.5:
-        return
-    
-    # route parsed message to the correct handler (nav or target).
-    # depending on design, the driver might just forward messages from the
-    #    modules to the Arduino with no additional processing
-    process_fcn(words[0])
-    return
+async def handle_msgs(stream, source, process_fcn, ignore_state):
+    # the stream only keeps the newest message, so nothing queued while the
+    #    driver was busy (or ignoring this source) is replayed
+    async for msg in stream:
+        age = message.age(msg)
+        latency[source].add(age)
+
+        # if delay between sending and receiving is greater than 0.5s, assume
+        #    that the message is old and drop it
+        if state == ignore_state or age > max_msg_age:
+            continue
+
+        # route parsed message to the correct handler (nav or target).
+        # depending on design, the driver might just forward messages from the
+        #    modules to the Arduino with no additional processing
+        last_handled[source] = time.monotonic()
+        previous = state
+        process_fcn(msg.command)
+        if state != previous:
+            state_switched(source)
+        state_changed.set()
+
+        # if an Arduino is behind, wait for it (the module's messages wait
+        #    in the pipe meanwhile)
+        await drain_ports()
+
+
+def state_switched(source):
+    # the state changed because of a message from source (None after a
+    #    timeout). Drop everything the other module queued meanwhile except
+    #    its newest message, so the new state starts on fresh data. The rest
+    #    of source's own messages are separate commands (e.g. a pan and then a
+    #    tilt) and are all handled
+    for other, channel in (("nav", nav_msgs), ("target", target_msgs)):
+        if other != source:
+            channel.coalesce()
+
+
+async def drain_ports():
+    for port in (mtr_write, tur_write):
+        if port is not sys.stdout:
+            await port.drain()
+
+
+def report_latency():
+    for histogram in latency.values():
+        print(histogram.report())
+    print("nav: {} messages dropped on state switches, target: {}".format(nav_msgs.dropped, target_msgs.dropped))
+    for source, ring in rings.items():
+        # read the newest record in place, it only counts if the child did not overwrite it meanwhile
+        viewed = ring.view()
+        if viewed is None:
+            print("{} ring: no frames".format(source))
+            continue
+        n, frame, record = viewed
+        summary = "{} ring: frame {}, last command {}, {} lines, {} blobs, {:.1f} ms old".format(
+            source, n, frame_ring.command(record), len(frame_ring.lines(record)), record["n_blobs"],
+            (time.monotonic_ns() - int(record["stamp"])) / 1e6)
+        if ring.valid(n):
+            print(summary)
+
+
+def close_rings():
+    for ring in rings.values():
+        ring.close()
+    rings.clear()
 
 
 if __name__=="__main__":
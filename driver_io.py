@@ -0,0 +1,111 @@
+# File:        driver_io.py
+# Platform:    Rasbian Buster with Python3
+# Description: asyncio streams for the driver's pipes and serial ports
+#
+# MessageStream turns a message.Channel (the pipe from the nav or targeting
+# process) into an async iterator of its messages, in order. The pipe is
+# drained as soon as it is readable; the driver coalesces the channel when it
+# switches state.
+#
+# Port wraps an Arduino serial port. Writes never block the event loop: what
+# the port does not take right away is buffered and written when the port is
+# writable again, and drain() waits until the buffer is below high_water
+# (like asyncio.StreamWriter.drain). readline() reads what the Arduino sends.
+
+import os
+import asyncio
+
+
+class MessageStream(object):
+    """ Messages from a message.Channel, as an async iterator (ends when the pipe is closed) """
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.ready = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self.loop.add_reader(channel.fd, self._readable)
+
+    def _readable(self):
+        # read the pipe right away, the (level triggered) reader would fire again for data left in it
+        if not self.channel.fill():
+            self.loop.remove_reader(self.channel.fd)
+        self.ready.set()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            msg = self.channel.pop()
+            if msg is not None:
+                return msg
+            if self.channel.closed:
+                raise StopAsyncIteration
+            self.ready.clear()
+            await self.ready.wait()
+
+
+class Port(object):
+    """ Serial port with non-blocking, back-pressured writes and async reads """
+
+    def __init__(self, port, high_water=64):
+        self.port = port            # serial.Serial
+        self.fd = port.fileno()
+        self.high_water = high_water    # bytes, drain() waits while more than this are buffered
+        self.buffer = bytearray()   # bytes written but not yet taken by the port
+        self.writing = False        # true while waiting for the port to be writable
+        self.drained = None         # future drain() waits on
+        self.reader = None          # asyncio.StreamReader, created by the first readline()
+        self.stalls = 0             # times the port did not take everything right away
+        os.set_blocking(self.fd, False)
+
+    def write(self, data):
+        """ Write without waiting, what the port does not take is buffered """
+        self.buffer += data
+        if not self.writing:
+            self._flush()
+
+    def _flush(self):
+        try:
+            written = os.write(self.fd, self.buffer)
+        except BlockingIOError:
+            written = 0
+        del self.buffer[:written]
+
+        loop = asyncio.get_running_loop()
+        if self.buffer and not self.writing:
+            loop.add_writer(self.fd, self._flush)
+            self.writing = True
+            self.stalls += 1
+        elif not self.buffer and self.writing:
+            loop.remove_writer(self.fd)
+            self.writing = False
+        if len(self.buffer) <= self.high_water and self.drained is not None:
+            if not self.drained.done():
+                self.drained.set_result(None)
+            self.drained = None
+
+    async def drain(self):
+        """ Wait until at most high_water bytes are buffered """
+        while len(self.buffer) > self.high_water:
+            if self.drained is None:
+                self.drained = asyncio.get_running_loop().create_future()
+            await self.drained
+
+    async def readline(self):
+        """ Next line from the port, b"" once it is closed """
+        if self.reader is None:
+            self.reader = asyncio.StreamReader()
+            asyncio.get_running_loop().add_reader(self.fd, self._readable)
+        return await self.reader.readline()
+
+    def _readable(self):
+        try:
+            data = os.read(self.fd, 1024)
+        except BlockingIOError:
+            return
+        if data:
+            self.reader.feed_data(data)
+        else:
+            asyncio.get_running_loop().remove_reader(self.fd)
+            self.reader.feed_eof()
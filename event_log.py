@@ -0,0 +1,106 @@
+# File:        event_log.py
+# Platform:    Rasbian Buster with Python3
+# Description: Structured event log written by a background thread
+#
+# Opening and closing a text log file for every line costs several syscalls
+# in the middle of the vision loop. EventLog.log() only puts a record (a dict)
+# on a queue; a writer thread takes the queued records in batches, writes them
+# as JSON lines and rotates the file when it grows past max_bytes
+# (log.jsonl -> log.jsonl.1 -> log.jsonl.2 ...).
+#
+# The writer thread is started by the first log() call in each process, so an
+# EventLog created before driver.py forks still works in the child processes.
+
+import os
+import json
+import atexit
+import time
+import queue
+import threading
+
+import numpy as np
+
+
+def to_json(value):
+    # numpy values (lines, counters) are converted by the writer thread, not by the caller
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class EventLog(object):
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=3, batch_size=256, queue_size=10000):
+        self.path = path                # file to write, None disables logging
+        self.max_bytes = max_bytes      # rotate the file when it is bigger than this
+        self.backups = backups          # number of rotated files to keep
+        self.batch_size = batch_size    # most records written at once
+        self.queue_size = queue_size    # records waiting to be written before new ones are dropped
+        self.dropped = 0                # records dropped because the queue was full
+
+        self._queue = None
+        self._thread = None
+        self._pid = None
+
+    def log(self, event, **fields):
+        """ Queue one record. Never blocks; the record is dropped if the writer has fallen too far behind """
+        if self.path is None:
+            return
+        if self._pid != os.getpid():
+            self._start()
+        fields["t"] = time.time()
+        fields["event"] = event
+        try:
+            self._queue.put_nowait(fields)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """ Write everything still queued and stop the writer thread """
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+        self._pid = None
+
+    def _start(self):
+        self._pid = os.getpid()
+        self._queue = queue.Queue(self.queue_size)
+        self._thread = threading.Thread(target=self._write, name="event_log")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("{}.{}".format(self.path, i)):
+                os.replace("{}.{}".format(self.path, i), "{}.{}".format(self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + ".1")
+        else:
+            os.remove(self.path)
+
+    def _write(self):
+        f = open(self.path, "a")
+        running = True
+        while running:
+            # wait for one record, then take whatever else is already queued
+            records = [self._queue.get()]
+            while len(records) < self.batch_size:
+                try:
+                    records.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                records = records[:records.index(None)]
+                running = False
+
+            f.write("".join(json.dumps(record, default=to_json) + "\n" for record in records))
+            f.flush()
+            if f.tell() > self.max_bytes:
+                f.close()
+                self._rotate()
+                f = open(self.path, "a")
+        f.close()
@@ -0,0 +1,190 @@
+# File:        frame_ring.py
+# Platform:    Rasbian with Python3.8+ (multiprocessing.shared_memory)
+# Description: Shared memory ring of the newest frames and their results
+#
+# The nav and targeting processes publish each processed frame together with a
+# result record (lane lines or target blobs, the last command sent to the
+# driver, timestamps) into a ring of slots in one multiprocessing.shared_memory
+# block. The driver and any observer (ring_monitor.py) attach by name and read
+# the newest slot in place, so nothing is pickled or sent through a pipe.
+#
+# Every slot is guarded by a seqlock: the writer sets the slot's seq to an odd
+# value, writes the record and frame, then sets it to 2 * frame number. A
+# reader checks seq before and after using the slot; if it changed, the writer
+# came round the ring meanwhile and the read is retried (read) or reported
+# (view/valid). There is one writer per ring, readers never block it.
+#
+# Memory ordering: there is no memory barrier between the seq stores and the
+# data stores (Python has no portable fence). On x86 stores become visible in
+# order, so the seqlock is sound there. The Pi's ARM cores may make stores
+# visible out of order to another core, so on the robot a reader can
+# (rarely) see a slot that passed valid() while some of its data is from the
+# previous frame. Use the rings for telemetry and debugging, not for anything
+# that drives the robot.
+#
+# Layout: header | records (slots x record) | frames (slots x height x width x channels)
+
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+import message
+
+ring_magic = 0x52494E47     # "RING"
+line_names = ("right", "left", "center")   # lane line slots of a record, in this order
+max_blobs = 8               # blobs per record
+
+header = np.dtype([("magic", "<u4"), ("slots", "<u4"), ("height", "<u4"), ("width", "<u4"),
+                   ("channels", "<u4"), ("pad", "<u4"), ("head", "<u8")], align=True)
+record = np.dtype([("seq", "<u8"),              # seqlock, 2 * frame number when complete, odd while written
+                   ("stamp", "<i8"),            # time.monotonic_ns() when published
+                   ("frame_time", "<i8"),       # time.monotonic_ns() when the frame was captured
+                   ("camera_seq", "<u8"),       # sequence number of the frame from the camera
+                   ("height", "<u2"), ("width", "<u2"),
+                   ("command", "u1"),           # message opcode of the last command sent, 0 for none
+                   ("msg_seq", "<u4"),          # message seq of the last command sent
+                   ("line_valid", "u1", (len(line_names),)),             # 1 if the lane line was found
+                   ("lines", "<i4", (len(line_names), 4)),               # [x1, y1, x2, y2] for line_names
+                   ("n_blobs", "u1"), ("blobs", "<f4", (max_blobs, 5))],   # [x, y, w, h, area]
+                  align=True)
+
+
+class FrameRing(object):
+    """ Ring of frames and result records in shared memory, one writer, any number of readers """
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner          # true for the process that created (and unlinks) the block
+        self.header = np.ndarray((), header, shm.buf)
+        self.slots = int(self.header["slots"])
+        self.shape = (int(self.header["height"]), int(self.header["width"]), int(self.header["channels"]))
+        self.records = np.ndarray((self.slots,), record, shm.buf, header.itemsize)
+        self.frames = np.ndarray((self.slots,) + self.shape, np.uint8, shm.buf,
+                                 header.itemsize + self.slots * record.itemsize)
+        self.retries = 0            # reads retried because the writer overwrote the slot
+
+    @classmethod
+    def create(cls, name, shape, slots=4):
+        """ New ring for frames of at most shape (height, width, channels) """
+        size = header.itemsize + slots * (record.itemsize + int(np.prod(shape)))
+        try:
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:     # left behind by a driver that did not exit cleanly
+            stale = shared_memory.SharedMemory(name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name, create=True, size=size)
+        head = np.ndarray((), header, shm.buf)
+        head[()] = (ring_magic, slots, shape[0], shape[1], shape[2], 0, 0)
+        ring = cls(shm, True)
+        ring.records["seq"] = 0
+        del head
+        return ring
+
+    @classmethod
+    def attach(cls, name):
+        """ Ring created by another process """
+        shm = shared_memory.SharedMemory(name)
+        # only the creator unlinks, keep the resource tracker from doing it when this process exits
+        resource_tracker.unregister(shm._name, "shared_memory")
+        if int(np.ndarray((), header, shm.buf)["magic"]) != ring_magic:
+            shm.close()
+            raise ValueError("{} is not a frame ring".format(name))
+        return cls(shm, False)
+
+    def close(self):
+        self.header = self.records = self.frames = None     # views must go before the buffer is released
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def head(self):
+        """ Number of the newest complete frame, 0 if none has been published """
+        return int(self.header["head"])
+
+    # --------------------------
+    # WRITER
+    # --------------------------
+
+    def publish(self, frame, command=None, msg_seq=0, lines=(), blobs=(), frame_time=None, camera_seq=0):
+        """ Copy the frame and its results into the next slot. lines are (right, left, center), each [] if not found.
+        Returns the frame number """
+        height, width = frame.shape[:2]
+        if height > self.shape[0] or width > self.shape[1]:
+            raise ValueError("{}x{} frame does not fit the {}x{} ring".format(width, height, self.shape[1],
+                                                                            self.shape[0]))
+        n = self.head() + 1
+        i = (n - 1) % self.slots
+        slot = self.records[i]
+        slot["seq"] = 2 * n - 1     # readers of this slot retry from here on
+
+        slot["stamp"] = time.monotonic_ns()
+        slot["frame_time"] = int(frame_time * 1e9) if frame_time is not None else slot["stamp"]
+        slot["camera_seq"] = camera_seq
+        slot["height"], slot["width"] = height, width
+        slot["command"] = message.opcodes.get(command, 0)       # 0 for None or a command without an opcode
+        slot["msg_seq"] = msg_seq & 0xFFFFFFFF
+        for j in range(len(line_names)):
+            line = lines[j] if j < len(lines) else []
+            slot["line_valid"][j] = len(line) > 0
+            if len(line):
+                slot["lines"][j] = line
+        blobs = np.asarray(blobs, dtype=np.float32).reshape(-1, 5)[:max_blobs]
+        slot["n_blobs"] = len(blobs)
+        slot["blobs"][:len(blobs)] = blobs
+        self.frames[i, :height, :width] = frame.reshape(height, width, -1)
+
+        slot["seq"] = 2 * n
+        self.header["head"] = n
+        return n
+
+    # --------------------------
+    # READERS
+    # --------------------------
+
+    def view(self, n=None):
+        """ (n, frame, record) views into slot of frame n (default the newest), without copying. None if frame n
+        is gone or not published. Check valid(n) after using the views """
+        if n is None:
+            n = self.head()
+        if n == 0 or n > self.head():
+            return None
+        i = (n - 1) % self.slots
+        slot = self.records[i]
+        if int(slot["seq"]) != 2 * n:
+            return None
+        return n, self.frames[i, :int(slot["height"]), :int(slot["width"])], slot
+
+    def valid(self, n):
+        """ True if frame n has not been overwritten, so views of it held good data """
+        return int(self.records[(n - 1) % self.slots]["seq"]) == 2 * n
+
+    def read(self, n=None, retries=10):
+        """ (n, frame, record) copies of frame n (default the newest), None if there is none """
+        for _ in range(retries):
+            viewed = self.view(n)
+            if viewed is None:
+                if n is not None:
+                    return None
+                continue
+            seq, frame, slot = viewed
+            frame, slot = frame.copy(), slot.copy()
+            if self.valid(seq):
+                return seq, frame, slot
+            self.retries += 1
+        return None
+
+
+def command(slot):
+    """ Command of a record, None if it has none """
+    return message.commands[slot["command"] - 1] if slot["command"] else None
+
+
+def lines(slot):
+    """ Lane lines of a record, {name: [x1, y1, x2, y2]} for the ones that were found """
+    return {name: slot["lines"][i] for i, name in enumerate(line_names) if slot["line_valid"][i]}
+
+
+def blobs(slot):
+    """ Blobs of a record, n x [x, y, w, h, area] """
+    return slot["blobs"][:slot["n_blobs"]]
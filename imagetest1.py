@@ -4,6 +4,7 @@ import numpy as np
 import time
 from datetime import datetime
 import sys
+import undistort
 from picamera.array import PiRGBArray
 from picamera import PiCamera
 
@@ -11,13 +12,6 @@ camera = PiCamera()
 camera.resolution = (640, 480)
 camera.rotation = 180
 
-# camera distortion corrections
-k = np.array([[243.48186479, 0., 305.08168044],
-              [0., 244.0802712, 226.73721762],
-              [0., 0., 1.]])
-
-d = np.array([-2.67227451e-01, 6.92939876e-02, 2.32058609e-03, 2.62454856e-05, -7.75020091e-03])
-
 # grab a reference to the raw camera capture
 rawCapture = PiRGBArray(camera, size=(640, 480))
 camera.capture(rawCapture, format="bgr")
@@ -26,11 +20,7 @@ camera.capture(rawCapture, format="bgr")
 raw_frame = rawCapture.array
 
 # un-distort image
-h, w = raw_frame.shape[:2]
-new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(k, d, (w, h), 0)
-map_x, map_y = cv2.initUndistortRectifyMap(k, d, None, new_camera_matrix, (w, h), 5)
-
-frame = cv2.remap(raw_frame, map_x, map_y, cv2.INTER_LINEAR)
+frame = undistort.undistort(raw_frame)
 
 
 """ Define Region of Interest (ROI) for the intersection """
@@ -0,0 +1,162 @@
+# File:        lane_tracker.py
+# Platform:    Rasbian Buster with Python3
+# Description: Frame to frame tracking of the yellow lane lines
+#
+# Each main line (left, right, center) found by LaneGuidev10.create_lanes is
+# run through an alpha-beta filter on its four endpoint coordinates. The
+# filter smooths the line (less LLL/RRR oscillation), keeps a line alive
+# through a few frames where it is missed, and predicts where the line will be
+# in the next frame. While the left and right lines are tracked confidently,
+# edge and line detection only has to look in narrow bands around those
+# predictions, plus the lane between them until a center line is tracked (so
+# a center line at a dead end is found as soon as it appears). Every few
+# frames, and whenever a track is lost, the whole ROI is searched again.
+#
+# A track is only predicted over frames that were processed and missed the
+# line. If frames were skipped (e.g. during a timed turn) for longer than
+# max_misses, the track is started over from the next measurement.
+#
+# Pixel values are for the 640 x 480 reference frame and are multiplied by the
+# scale passed in by LaneGuidev10.
+
+import cv2
+import numpy as np
+
+# filter and search settings
+alpha = 0.6             # how much of a measurement is taken into the position (1 = no smoothing)
+beta = 0.2              # how much of a measurement is taken into the velocity
+gate = 80               # px, a measurement further than this from the prediction restarts the track
+band = 40               # px, half width of the search band around a predicted line
+min_hits = 3            # frames a line must be seen in a row before its band is used for searching
+max_misses = 2          # frames a line is kept (predicted) without being seen
+full_search_every = 5   # frames, the whole ROI is searched at least this often
+
+
+class LineTrack(object):
+    """ Alpha-beta filter on the [x1, y1, x2, y2] endpoints of one line """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.position = None    # filtered [x1, y1, x2, y2], None if not tracking
+        self.velocity = np.zeros(4)
+        self.hits = 0           # frames in a row the line was measured
+        self.misses = 0         # frames in a row the line was not measured
+
+    def tracking(self):
+        return self.position is not None
+
+    def confident(self):
+        return self.tracking() and self.hits >= min_hits and self.misses == 0
+
+    def predict(self, steps=1):
+        return self.position + self.velocity * steps
+
+    def update(self, measured, steps=1, scale=1.0):
+        """ Take one frame's measurement ([] if the line was not found) and return the line to use, or []. steps
+        is the number of frames since the last update """
+        if self.tracking() and steps - 1 > max_misses:
+            self.reset()        # too long without a look at the line to predict it
+        if len(measured) > 0:
+            measured = np.asarray(measured, dtype=np.float64)
+            if not self.tracking():
+                self.position = measured
+                self.velocity = np.zeros(4)
+                self.hits = 1
+            else:
+                predicted = self.predict(steps)
+                residual = measured - predicted
+                if np.abs(residual).max() > gate * scale:
+                    # too far from where the line should be, start over from this measurement
+                    self.position = measured
+                    self.velocity = np.zeros(4)
+                    self.hits = 1
+                else:
+                    self.position = predicted + alpha * residual
+                    self.velocity = self.velocity + beta * residual / steps
+                    self.hits += 1
+            self.misses = 0
+        elif self.tracking():
+            self.misses += 1
+            self.hits = 0
+            if self.misses > max_misses:
+                self.reset()
+                return []
+            self.position = self.predict(steps)
+        else:
+            return []
+        return np.array([int(self.position[0]), int(self.position[1]), int(self.position[2]), int(self.position[3])])
+
+
+class LaneTracker(object):
+
+    def __init__(self):
+        self.left = LineTrack()
+        self.right = LineTrack()
+        self.center = LineTrack()
+        self.seq = None             # sequence number of the last frame given to update()
+        self.since_full = 0         # frames since the whole ROI was searched
+        self.full_searches = 0      # frames searched over the whole ROI
+        self.band_searches = 0      # frames searched only in the predicted bands
+
+    def reset(self):
+        """ Forget all tracks (e.g. when the robot turns), the next frame searches the whole ROI """
+        self.left.reset()
+        self.right.reset()
+        self.center.reset()
+        self.seq = None
+        self.since_full = 0
+
+    def search_bands(self, shape, scale=1.0):
+        """ Return (rect, mask) limiting the next search to bands around the predicted left/right lines (and the
+        lane between them while there is no center track), or None if the whole ROI must be searched. rect is
+        (top, bottom, left, right) in frame pixels and mask is a uint8 image of the rect size that is 255 inside
+        the search area """
+        if self.since_full + 1 >= full_search_every or not (self.left.confident() and self.right.confident()):
+            self.since_full = 0
+            self.full_searches += 1
+            return None
+
+        rows, cols = shape[:2]
+        half = max(int(band * scale), 1)
+        # the endpoints of a line are less certain than its direction, so each band runs along the whole
+        # predicted line, extended by its own length at both ends
+        lines = []
+        for track in (self.left, self.right, self.center):
+            if track.confident():
+                x1, y1, x2, y2 = track.predict()
+                dx, dy = x2 - x1, y2 - y1
+                lines.append(np.array([x1 - dx, y1 - dy, x2 + dx, y2 + dy]))
+        points = np.concatenate([line.reshape(2, 2) for line in lines])
+        left, top = np.maximum(points.min(axis=0).astype(int) - half, 0)
+        right, bottom = np.minimum(points.max(axis=0).astype(int) + half, (cols - 1, rows - 1))
+        if right <= left or bottom <= top:
+            self.since_full = 0
+            self.full_searches += 1
+            return None
+
+        mask = np.zeros((bottom - top + 1, right - left + 1), dtype=np.uint8)
+        for line in lines:
+            x1, y1, x2, y2 = (line - (left, top, left, top)).astype(int)
+            cv2.line(mask, (int(x1), int(y1)), (int(x2), int(y2)), 255, 2 * half)     # clipped to the mask
+        if not self.center.confident():
+            # a new center line runs across the lane, search all of the lane between the left and right lines
+            lane = (np.concatenate([line.reshape(2, 2) for line in lines[:2]]) - (left, top)).astype(np.int32)
+            cv2.fillConvexPoly(mask, cv2.convexHull(lane), 255)
+        self.since_full += 1
+        self.band_searches += 1
+        return (int(top), int(bottom), int(left), int(right)), mask
+
+    def update(self, right_line, left_line, center_line, seq=None, scale=1.0):
+        """ Filter one frame of create_lanes output. Returns (right_line, left_line, center_line) like
+        create_lanes, with missed lines predicted for up to max_misses frames """
+        steps = 1
+        if seq is not None and self.seq is not None and seq > self.seq:
+            steps = seq - self.seq
+        self.seq = seq
+        right_line = self.right.update(right_line, steps, scale)
+        left_line = self.left.update(left_line, steps, scale)
+        center_line = self.center.update(center_line, steps, scale)
+        return right_line, left_line, center_line
+
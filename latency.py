@@ -0,0 +1,52 @@
+# File:        latency.py
+# Platform:    Rasbian Buster with Python3
+# Description: Latency histograms
+#
+# LatencyHistogram counts latencies into fixed buckets (0.1 ms to 1 s, 1-2-5
+# steps), so adding one is cheap enough to do for every message the driver
+# handles. Percentiles are read from the buckets, so they are upper bounds.
+
+import bisect
+
+bounds = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]     # ms, upper bound of each bucket
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = [0] * (len(bounds) + 1)   # the last bucket is everything over bounds[-1]
+        self.count = 0
+        self.total = 0.0            # ms
+        self.max = 0.0              # ms
+
+    def add(self, seconds):
+        ms = 1e3 * seconds
+        self.counts[bisect.bisect_left(bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        """ Upper bound (ms) of the bucket holding the p-th percentile """
+        if self.count == 0:
+            return 0.0
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= p / 100 * self.count:
+                return bounds[i] if i < len(bounds) else self.max
+        return self.max
+
+    def report(self):
+        if self.count == 0:
+            return "{}: no messages".format(self.name)
+        lines = ["{}: {} messages, mean {:.2f} ms, p50 <= {} ms, p99 <= {} ms, max {:.2f} ms".format(
+            self.name, self.count, self.total / self.count, self.percentile(50), self.percentile(99), self.max)]
+        low = 0
+        for i, n in enumerate(self.counts):
+            high = bounds[i] if i < len(bounds) else float("inf")
+            if n:
+                lines.append("    {:>7} - {:<7} ms {:8d} {}".format(low, high, n, "#" * max(1, 40 * n // self.count)))
+            low = high
+        return "\n".join(lines)
@@ -0,0 +1,120 @@
+# File:        maneuver.py
+# Platform:    Rasbian Buster with Python3
+# Description: Timed maneuvers (turns) that do not block the vision loop
+#
+# The motor Arduino stops if it does not get a command within cmd_timeout
+# (500 ms for rotations, 1200 ms for everything else, see MotorDriver.ino).
+# Instead of sending the turn command in a busy loop for the whole turn, a
+# Maneuver re-sends it from update(), which the vision loop calls once per
+# frame. update() keeps track of the longest recent gap between its calls and
+# re-sends early enough that the next call cannot come after the refresh
+# deadline, just under that timeout. When no frame comes (camera stall), the
+# vision loop waits at most wait_time() for one and then calls update() anyway,
+# so the command is still repeated in time. The maneuver ends when its
+# duration is up or when it is cancelled; an optional follow-up command is sent
+# when it is done.
+
+import time
+from collections import deque
+
+import message
+
+# seconds by which a command must be repeated, just under the Arduino cmd_timeout
+refresh_rotate = 0.4        # <LLL>/<RRR>, cmd_timeout_r = 500 ms
+refresh_translate = 1.0     # everything else, cmd_timeout_t = 1200 ms
+refresh_periods = {"<LLL>": refresh_rotate, "<RRR>": refresh_rotate}
+period_history = 8          # update() calls the frame period is taken over
+
+
+class Maneuver(object):
+
+    def __init__(self, send, log=None):
+        self.send = send            # function sending one command
+        self.log = log              # function called with a dict of statistics when a maneuver ends
+        self.command = None         # command being repeated, None if no maneuver is running
+        self.then = None            # command sent once the maneuver is done, None for none
+        self.gaps = deque(maxlen=period_history)    # sec, recent gaps between update() calls
+        self.last_update = 0        # time.monotonic() of the last update() call
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.start_time = 0         # time.monotonic() the maneuver started
+        self.last_sent = 0          # time.monotonic() the command was last sent
+        self.duration = 0           # sec
+        self.refresh = 0            # sec
+        self.sent = 0               # commands sent during the maneuver
+        self.bytes_sent = 0         # bytes sent during the maneuver (one message frame per command)
+        self.cpu_start = 0          # time.process_time() the maneuver started
+
+    def active(self):
+        return self.command is not None
+
+    def elapsed(self):
+        return time.monotonic() - self.start_time if self.active() else 0
+
+    def frame_period(self):
+        """ Longest recent gap between update() calls (sec), 0 until there have been two """
+        return max(self.gaps) if self.gaps else 0
+
+    def wait_time(self):
+        """ Seconds until update() must be called to re-send the command or end the maneuver, None if none is
+        running """
+        if not self.active():
+            return None
+        deadline = min(self.last_sent + self.refresh, self.start_time + self.duration)
+        return max(deadline - time.monotonic(), 0)
+
+    def start(self, command, duration, refresh=None, then=None):
+        """ Start repeating command for duration seconds, then send the command then (if given). The caller sends
+        the first command. Returns False (and does nothing) for a zero length maneuver """
+        if self.active():
+            self._finish("replaced")
+        if duration <= 0:
+            return False
+        self.reset_stats()
+        self.command = command
+        self.then = then
+        self.duration = duration
+        self.refresh = refresh if refresh is not None else refresh_periods.get(command, refresh_translate)
+        self.start_time = self.last_sent = time.monotonic()
+        self.cpu_start = time.process_time()
+        self.sent = 1
+        self.bytes_sent = message.frame_size
+        return True
+
+    def update(self):
+        """ Re-send the command if its refresh period is up. Returns True while the maneuver is still running """
+        if not self.active():
+            return False
+        now = time.monotonic()
+        if self.last_update:
+            self.gaps.append(now - self.last_update)
+        self.last_update = now
+        if now - self.start_time >= self.duration:
+            then = self.then
+            self._finish("done")
+            if then is not None:
+                self.send(then)
+            return False
+        # the next call is expected within one frame period, re-send now if that would be past the deadline
+        if now - self.last_sent + self.frame_period() >= self.refresh:
+            self.send(self.command)
+            self.last_sent = now
+            self.sent += 1
+            self.bytes_sent += message.frame_size
+        return True
+
+    def cancel(self):
+        """ End the maneuver early (without sending the follow-up command) """
+        if self.active():
+            self._finish("cancelled")
+
+    def _finish(self, reason):
+        if self.log is not None:
+            self.log({"command": self.command, "reason": reason, "elapsed": time.monotonic() - self.start_time,
+                      "duration": self.duration, "sent": self.sent, "bytes": self.bytes_sent,
+                      "cpu": time.process_time() - self.cpu_start, "frame_period": self.frame_period()})
+        self.command = None
+        self.then = None
+        self.last_update = 0
+        self.gaps.clear()
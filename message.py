@@ -0,0 +1,157 @@
+# File:        message.py
+# Platform:    Rasbian Buster with Python3
+# Description: Binary messages between the driver and the nav/targeting processes
+#
+# Every message is one fixed-size frame packed with struct:
+#
+#     magic    B   0xC1, marks the start of a frame
+#     opcode   B   the command (see commands)
+#     length   H   bytes of payload used
+#     seq      I   sequence number, counted by each sender
+#     stamp    q   time.monotonic_ns() when the message was sent
+#     payload  16s optional data, zero padded
+#
+# time.monotonic_ns() is the same clock in every process on the Pi, so the
+# driver can tell how old a message is without parsing text or worrying about
+# the minute wrapping. A pipe read can return part of a frame; FrameBuffer
+# keeps the partial frame until the rest arrives. Reader waits for messages,
+# Channel reads the driver's pipes without waiting and hands the messages out
+# in order. When the driver switches state it calls coalesce() on the pipe
+# it now listens to, which drops everything pending but the newest message,
+# so the new state starts on fresh data instead of a backlog.
+
+import os
+import time
+import struct
+from collections import deque, namedtuple
+
+frame_format = struct.Struct("<BBHIq16s")
+frame_size = frame_format.size      # bytes, 32
+magic = 0xC1
+payload_size = 16                   # bytes, most payload a message can carry
+
+# commands sent by navigation and targeting, opcode = index + 1
+commands = ["<STP>", "<FWD>", "<BCK>", "<LFT>", "<RGT>", "<LLL>", "<RRR>",
+            "<FIR>", "<UPP>", "<DWN>", "<HOM>"]
+opcodes = {command: i + 1 for i, command in enumerate(commands)}
+
+Message = namedtuple("Message", ["command", "seq", "stamp", "payload"])
+
+
+def encode(command, seq, payload=b"", stamp=None):
+    """ Pack one message into a frame_size byte frame """
+    if len(payload) > payload_size:
+        raise ValueError("payload is {} bytes, at most {} fit in a message".format(len(payload), payload_size))
+    if stamp is None:
+        stamp = time.monotonic_ns()
+    return frame_format.pack(magic, opcodes[command], len(payload), seq & 0xFFFFFFFF, stamp, payload)
+
+
+def decode(frame):
+    """ Unpack one frame into a Message """
+    start, opcode, length, seq, stamp, payload = frame_format.unpack(frame)
+    if start != magic or not 0 < opcode <= len(commands):
+        raise ValueError("not a message frame")
+    return Message(commands[opcode - 1], seq, stamp, payload[:length])
+
+
+def age(message):
+    """ Seconds since the message was sent """
+    return (time.monotonic_ns() - message.stamp) / 1e9
+
+
+class FrameBuffer(object):
+    """ Collects bytes read from a pipe and cuts them into messages, keeping partial frames between reads """
+
+    def __init__(self, fd, chunk=64 * frame_size):
+        self.fd = fd if isinstance(fd, int) else fd.fileno()
+        self.chunk = chunk          # most bytes read from the pipe at once
+        self.buffer = bytearray()
+        self.skipped = 0            # bytes dropped while looking for the start of a frame
+        self.closed = False         # true once the writer has closed the pipe
+
+    def next(self):
+        """ Return the first complete message in the buffer (without reading), or None """
+        while len(self.buffer) >= frame_size:
+            if self.buffer[0] == magic:
+                try:
+                    message = decode(bytes(self.buffer[:frame_size]))
+                    del self.buffer[:frame_size]
+                    return message
+                except ValueError:
+                    pass
+            # out of step (should not happen on a pipe), drop a byte and look for the next frame start
+            self.skipped += 1
+            del self.buffer[:1]
+        return None
+
+    def messages(self):
+        """ Return all complete messages in the buffer, without reading """
+        messages = []
+        message = self.next()
+        while message is not None:
+            messages.append(message)
+            message = self.next()
+        return messages
+
+
+class Reader(FrameBuffer):
+    """ Reads whole messages from a pipe, waiting for them """
+
+    def fill(self):
+        """ Read what is in the pipe (waits for at least one byte). Returns False once the pipe is closed """
+        data = os.read(self.fd, self.chunk)
+        if not data:
+            self.closed = True
+            return False
+        self.buffer += data
+        return True
+
+    def read(self):
+        """ Wait for and return the next message, None once the pipe is closed """
+        message = self.next()
+        while message is None:
+            if not self.fill():
+                return None
+            message = self.next()
+        return message
+
+
+class Channel(FrameBuffer):
+    """ Reads a pipe without waiting. Messages are handed out in order; coalesce() drops all but the newest """
+
+    def __init__(self, fd, chunk=64 * frame_size):
+        super().__init__(fd, chunk)
+        os.set_blocking(self.fd, False)
+        self.queue = deque()        # complete messages not handed out yet
+        self.dropped = 0            # messages dropped by coalesce() before they were handled
+
+    def fill(self):
+        """ Read everything in the pipe without waiting. Returns False once the pipe is closed """
+        while True:
+            try:
+                data = os.read(self.fd, self.chunk)
+            except BlockingIOError:
+                return True
+            if not data:
+                self.closed = True
+                return False
+            self.buffer += data
+
+    def pop(self):
+        """ Oldest message not handed out yet, None if there is none (does not read) """
+        self.queue.extend(self.messages())
+        return self.queue.popleft() if self.queue else None
+
+    def coalesce(self):
+        """ Drain the pipe and drop all pending messages but the newest """
+        self.fill()
+        self.queue.extend(self.messages())
+        while len(self.queue) > 1:
+            self.queue.popleft()
+            self.dropped += 1
+
+    def latest(self):
+        """ Drain the pipe and return the newest message (None if there is none), dropping the rest """
+        self.coalesce()
+        return self.pop()
@@ -0,0 +1,103 @@
+# File:        message_bench.py
+# Platform:    Python3 (dev box or Rasbian Buster)
+# Description: Throughput of the driver messages over os.pipe
+#
+# A forked writer sends messages through an os.pipe like the nav and
+# targeting processes do, and the reader handles them like driver.py. Compares
+# the binary message frames (message.py) with the previous 50 byte text
+# messages that carried a datetime.now().strftime('%S.%f') timestamp. A second
+# run splits the frames into random sized writes to check that messages
+# survive partial reads.
+#
+# usage:
+#     message_bench.py [<messages, default 100000>]
+
+import os
+import sys
+import time
+import random
+from datetime import datetime
+
+import message
+
+text_msg_size = 50          # size of the previous text messages
+
+
+def run(writer, reader, count):
+    """ Fork writer(fd, count), run reader(fd, count) here. Returns messages per second """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        writer(w, count)
+        os.close(w)
+        os._exit(0)
+    os.close(w)
+    start = time.perf_counter()
+    reader(r, count)
+    elapsed = time.perf_counter() - start
+    os.close(r)
+    os.waitpid(pid, 0)
+    return count / elapsed
+
+
+def write_text(fd, count):
+    f = os.fdopen(fd, 'w', closefd=False)
+    for i in range(count):
+        f.write("{} {}".format(message.commands[i % len(message.commands)],
+                               datetime.now().strftime('%S.%f')).ljust(text_msg_size))
+        f.flush()
+
+
+def read_text(fd, count):
+    f = os.fdopen(fd, closefd=False)
+    for i in range(count):
+        words = f.read(text_msg_size).strip().split()
+        received = float(datetime.now().strftime('%S.%f'))
+        if received - float(words[-1]) > 0.5:
+            continue
+        assert words[0] == message.commands[i % len(message.commands)]
+
+
+def write_binary(fd, count):
+    f = os.fdopen(fd, 'wb', closefd=False)
+    for i in range(count):
+        f.write(message.encode(message.commands[i % len(message.commands)], i))
+        f.flush()
+
+
+def write_binary_split(fd, count):
+    # the same bytes, written in random sized pieces that split frames
+    data = b"".join(message.encode(message.commands[i % len(message.commands)], i) for i in range(count))
+    rng = random.Random(1)
+    i = 0
+    while i < len(data):
+        n = rng.randint(1, 3 * message.frame_size)
+        os.write(fd, data[i:i + n])
+        i += n
+
+
+def read_binary(fd, count):
+    reader = message.Reader(fd)
+    for i in range(count):
+        msg = reader.read()
+        if message.age(msg) > 0.5:
+            continue
+        assert msg.seq == i and msg.command == message.commands[i % len(message.commands)]
+    assert reader.read() is None and reader.skipped == 0
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    text = run(write_text, read_text, count)
+    binary = run(write_binary, read_binary, count)
+    split = run(write_binary_split, read_binary, count)
+    print("{} messages over os.pipe".format(count))
+    print("{:>28}: {:10.0f} messages/s".format("text, {} bytes".format(text_msg_size), text))
+    print("{:>28}: {:10.0f} messages/s ({:.2f}x)".format("binary, {} bytes".format(message.frame_size),
+                                                          binary, binary / text))
+    print("{:>28}: {:10.0f} messages/s, all messages intact".format("binary, split writes", split))
+
+
+if __name__ == "__main__":
+    main()
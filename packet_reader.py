@@ -0,0 +1,106 @@
+# File:        packet_reader.py
+# Platform:    Rasbian Buster with Python3
+# Description: Background reader for the Luxonis camera packet queue
+#
+# The Luxonis camera sends packets at a constant FPS and crashes when its
+# buffer fills up (see the targeting.py header), so the buffer has to be read
+# all the time, even while a frame is being processed. PacketReader runs a
+# thread that keeps calling get_available_data_packets() on the pipeline from
+# camera_init() and keeps only the newest packet of each stream (previewout,
+# metaout, depth, ...). Readers get that packet with its receive time and
+# sequence number; packets nobody read before the next one arrived are counted
+# as dropped.
+#
+# With nnet=True the reader calls get_available_nnet_and_data_packets()
+# instead and keeps the newest neural network packet (the MobileNet-SSD
+# detections) under the stream name "metaout".
+
+import time
+import threading
+
+
+class PacketReader(object):
+
+    def __init__(self, pipeline, nnet=False, poll=0.002):
+        self.pipeline = pipeline    # depthai pipeline from camera_init()
+        self.nnet = nnet            # also read the neural network packets (as stream "metaout")
+        self.poll = poll            # sec, wait between reads when the device had nothing new
+
+        self.packets = {}           # stream name -> newest packet
+        self.timestamps = {}        # stream name -> time.monotonic() the newest packet was received
+        self.seqs = {}              # stream name -> sequence number of the newest packet, 0 = none yet
+        self.received = {}          # stream name -> packets received
+        self.dropped = {}           # stream name -> packets replaced before anyone read them
+        self.error = None           # exception that stopped the reader thread, if any
+
+        self._read_seqs = {}
+        self._running = False
+        self._thread = None
+        self._new_packet = threading.Condition()
+
+    def start(self):
+        """ Start reading in the background """
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._read, name="packet_reader")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stop reading and wait for the reader thread to finish """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def running(self):
+        return self._running
+
+    def read(self, stream, after_seq=None, timeout=1.0):
+        """ Return (packet, timestamp, seq) for the newest packet of stream. If after_seq is given, wait (up to
+        timeout seconds) for a packet newer than that one. packet is None if nothing arrived """
+        with self._new_packet:
+            if after_seq is not None and self.seqs.get(stream, 0) <= after_seq:
+                self._new_packet.wait_for(lambda: self.seqs.get(stream, 0) > after_seq or not self._running,
+                                          timeout)
+            seq = self.seqs.get(stream, 0)
+            if after_seq is not None and seq <= after_seq:
+                return None, self.timestamps.get(stream, 0), seq
+            self._read_seqs[stream] = seq
+            return self.packets.get(stream), self.timestamps.get(stream, 0), seq
+
+    def _publish(self, packets, stream=None):
+        now = time.monotonic()
+        with self._new_packet:
+            for packet in packets:
+                name = stream if stream is not None else packet.stream_name
+                seq = self.seqs.get(name, 0)
+                if seq > self._read_seqs.get(name, 0):
+                    self.dropped[name] = self.dropped.get(name, 0) + 1
+                self.packets[name] = packet
+                self.timestamps[name] = now
+                self.seqs[name] = seq + 1
+                self.received[name] = self.received.get(name, 0) + 1
+            self._new_packet.notify_all()
+
+    def _read(self):
+        try:
+            while self._running:
+                if self.nnet:
+                    nnet_packets, packets = self.pipeline.get_available_nnet_and_data_packets()
+                    if nnet_packets:
+                        self._publish(nnet_packets, "metaout")
+                else:
+                    nnet_packets, packets = [], self.pipeline.get_available_data_packets()
+                if packets:
+                    self._publish(packets)
+                if not packets and not nnet_packets:
+                    time.sleep(self.poll)
+        except Exception as e:
+            self.error = e
+            raise
+        finally:
+            with self._new_packet:
+                self._running = False
+                self._new_packet.notify_all()
@@ -0,0 +1,212 @@
+# File:        replay.py
+# Platform:    Python3 (dev box or Rasbian Buster)
+# Description: Run the LaneGuidev10 pipeline on recorded frames
+#
+# Feeds a video file or a directory of JPEGs (e.g. testimage.jpg) through
+# LaneGuidev10.main() without the robot: a stub camera stream hands out the
+# recorded frames, a virtual clock advances one frame period per frame (so
+# timed turns take the same number of frames as on the robot), commands are
+# recorded instead of sent, and every pipeline stage is timed.
+#
+# usage:
+#     replay.py <video, image or directory of .jpg frames> [--fps 16] [--size 640x480] [--repeat N]
+#               [--commands out.jsonl] [--log events.jsonl]
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import cv2
+
+import message
+import undistort
+import maneuver
+import event_log
+import LaneGuidev10 as lg
+
+# LaneGuidev10 functions timed as pipeline stages, in pipeline order
+stages = ["undistort", "segment_colors", "lane_roi", "process_lanes", "create_lanes", "track_lanes",
+          "intersection_roi", "process_intersection", "create_intersection", "guidance_decision", "navigation"]
+
+
+def read_frames(source):
+    """ Load all frames from a video file or a directory of JPEGs """
+    if os.path.isdir(source):
+        names = sorted(glob.glob(os.path.join(source, "*.jpg")) + glob.glob(os.path.join(source, "*.JPG")))
+        return [cv2.imread(name) for name in names]
+    if source.lower().endswith((".jpg", ".jpeg", ".png")):
+        return [cv2.imread(source)]
+    frames = []
+    video = cv2.VideoCapture(source)
+    while True:
+        ok, frame = video.read()
+        if not ok:
+            break
+        frames.append(frame)
+    video.release()
+    return frames
+
+
+class VirtualClock(object):
+    """ Stands in for the time module: time only moves when advance() is called """
+
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def process_time(self):
+        return time.process_time()
+
+
+class StubStream(object):
+    """ Stands in for camera_stream.CameraStream, handing out one recorded frame at a time """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.frame = None
+        self.timestamp = 0
+        self.seq = 0
+        self.dropped = 0
+        self.error = None
+
+    def push(self, frame):
+        self.frame = frame
+        self.timestamp = self.clock.monotonic()
+        self.seq += 1
+
+    def read(self, after_seq=None, timeout=1.0):
+        if after_seq is not None and self.seq <= after_seq:
+            return None, self.timestamp, self.seq
+        return self.frame, self.timestamp, self.seq
+
+    def running(self):
+        return True
+
+
+class CommandRecorder(object):
+    """ Stands in for the pipe to the driver, keeping every command with its frame and virtual time """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.commands = []          # (frame seq, virtual time, command)
+
+    def write(self, data):
+        self.commands.append((lg.frame_seq, self.clock.time(), message.decode(data).command))
+
+    def flush(self):
+        pass
+
+
+class StageTimer(object):
+    """ Wraps pipeline functions to record how long each call takes """
+
+    def __init__(self):
+        self.times = {}
+
+    def wrap(self, name, fcn):
+        times = self.times.setdefault(name, [])
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            result = fcn(*args, **kwargs)
+            times.append(time.perf_counter() - start)
+            return result
+        return timed
+
+    def report(self, frames):
+        total = sum(sum(t) for t in self.times.values())
+        print("{:>20} {:>7} {:>9} {:>9} {:>9} {:>7}".format("stage", "calls", "mean ms", "p95 ms", "ms/frame", "share"))
+        for name in stages:
+            times = sorted(self.times.get(name, []))
+            if not times:
+                continue
+            print("{:>20} {:>7} {:>9.3f} {:>9.3f} {:>9.3f} {:>6.1%}".format(
+                name, len(times), 1e3 * sum(times) / len(times), 1e3 * times[int(0.95 * (len(times) - 1))],
+                1e3 * sum(times) / frames, sum(times) / total if total else 0))
+
+
+def setup(clock, timer, commands):
+    """ Point LaneGuidev10 at the stub stream, virtual clock and command recorder and time its stages """
+    stream = StubStream(clock)
+    lg.stream = stream
+    lg.initialized = True
+    lg.nav_write = commands
+    lg.time = clock
+    maneuver.time = clock
+    event_log.time = clock
+
+    # no windows or image files: waitKey is not implemented in opencv-python-headless, and main() saves a jpg of
+    # every intersection decision into the working directory
+    cv2.waitKey = lambda delay=0: -1
+    cv2.imwrite = lambda filename, image, *args: True
+
+    undistort.undistort = timer.wrap("undistort", undistort.undistort)
+    lg.lane_tracker.update = timer.wrap("track_lanes", lg.lane_tracker.update)
+    for name in stages:
+        if name not in ("undistort", "track_lanes"):
+            setattr(lg, name, timer.wrap(name, getattr(lg, name)))
+    return stream
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded frames through LaneGuidev10")
+    parser.add_argument("source", help="video file, image, or directory of .jpg frames")
+    parser.add_argument("--fps", type=float, default=16.0, help="frame rate the frames were recorded at")
+    parser.add_argument("--size", default=None, help="resize frames to WIDTHxHEIGHT (e.g. 320x240)")
+    parser.add_argument("--repeat", type=int, default=1, help="play the frames this many times")
+    parser.add_argument("--commands", default=None, help="write the commands sent to this .jsonl file")
+    parser.add_argument("--log", default=None, help="write the LaneGuidev10 event log to this file")
+    args = parser.parse_args()
+
+    frames = read_frames(args.source)
+    if not frames or frames[0] is None:
+        print("No frames found in {}".format(args.source))
+        sys.exit(1)
+    if args.size is not None:
+        size = tuple(int(v) for v in args.size.split("x"))
+        frames = [cv2.resize(frame, size, interpolation=cv2.INTER_AREA) for frame in frames]
+    frames = frames * args.repeat
+
+    lg.event_log.path = args.log
+    clock = VirtualClock()
+    timer = StageTimer()
+    commands = CommandRecorder(clock)
+    stream = setup(clock, timer, commands)
+
+    start = time.perf_counter()
+    for frame in frames:
+        clock.advance(1.0 / args.fps)
+        stream.push(frame)
+        lg.main()
+    elapsed = time.perf_counter() - start
+    lg.event_log.close()
+
+    print("{} frames from {} in {:.2f} s: {:.1f} FPS ({:.1f} FPS recorded)".format(
+        len(frames), args.source, elapsed, len(frames) / elapsed, args.fps))
+    timer.report(len(frames))
+    counts = {}
+    for seq, t, command in commands.commands:
+        counts[command] = counts.get(command, 0) + 1
+    print("commands sent: {}".format(", ".join("{} x{}".format(c, n) for c, n in sorted(counts.items()))))
+
+    if args.commands is not None:
+        with open(args.commands, "w") as f:
+            for seq, t, command in commands.commands:
+                f.write(json.dumps({"frame": seq, "t": round(t, 6), "command": command}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# File:        resolution_report.py
+# Platform:    Python3 (dev box or Rasbian Buster)
+# Description: Compare LaneGuidev10 decisions and frame rate across resolutions
+#
+# Runs the lane/intersection pipeline on recorded frames at the full 640 x 480
+# reference resolution and at the low resolution fast modes, and reports how
+# often each resolution makes the same navigation decision as 640 x 480 and
+# how many frames per second it processes.
+#
+# usage:
+#     resolution_report.py <video file or directory of .jpg frames> [<width>x<height> ...]
+
+import os
+import sys
+import time
+import cv2
+
+import undistort
+import LaneGuidev10 as lg
+from replay import read_frames
+
+resolutions = [(640, 480), (320, 240), (160, 120)]
+
+
+def reset_state():
+    """ Put the LaneGuidev10 state machine back to its start so every frame is judged on its own """
+    lg.state1 = 0
+    lg.intersection_state = 0
+    lg.int_count = 0
+    lg.forward_count = 0
+    lg.turn = "<FWD>"
+
+
+def decide(raw_frame):
+    """ Run one frame through the pipeline and return (navigation command, intersection seen) """
+    reset_state()
+    h, w = raw_frame.shape[:2]
+    frame = undistort.undistort(raw_frame, first_row=int(h * lg.undistort_top))
+    lg.set_frame_size(frame)
+    yellow, purple = lg.segment_colors(frame)
+    lane_edges, lane_offset = lg.process_lanes(yellow, lg.lane_roi(frame))
+    right_line, left_line, center_line = lg.create_lanes(lane_edges, frame, lane_offset)
+    intersection_edges, processed, intersection_offset = lg.process_intersection(purple, lg.intersection_roi(frame))
+    lg.create_intersection(intersection_edges, frame, intersection_offset)
+    command = lg.navigation(frame, center_line, right_line, left_line)
+    return command, lg.state1 == 1
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: resolution_report.py <video file or directory of .jpg frames> [<width>x<height> ...]")
+        sys.exit(1)
+    sizes = resolutions
+    if len(sys.argv) > 2:
+        sizes = [tuple(int(v) for v in arg.split("x")) for arg in sys.argv[2:]]
+    if sizes[0] != (lg.ref_width, lg.ref_height):
+        sizes = [(lg.ref_width, lg.ref_height)] + sizes
+
+    frames = read_frames(sys.argv[1])
+    if not frames:
+        print("No frames found in {}".format(sys.argv[1]))
+        sys.exit(1)
+
+    # keep the pipeline quiet: no log file, no commands, no timed turns
+    lg.event_log.path = None
+    lg.nav_write = open(os.devnull, "wb")
+    lg.delay_0 = lg.delay_90 = lg.delay_180 = 0
+
+    results = {}
+    for size in sizes:
+        # the camera would capture at this size, INTER_AREA is the closest match to the sensor binning
+        scaled = [cv2.resize(frame, size, interpolation=cv2.INTER_AREA) for frame in frames]
+        decide(scaled[0])       # build (or load) the undistortion maps outside the timing
+        start = time.perf_counter()
+        decisions = [decide(frame) for frame in scaled]
+        elapsed = time.perf_counter() - start
+        results[size] = (decisions, len(scaled) / elapsed)
+
+    reference, ref_fps = results[sizes[0]]
+    print("{} frames from {}".format(len(frames), sys.argv[1]))
+    print("{:>10} {:>8} {:>9} {:>16} {:>20}".format("size", "FPS", "speedup", "command agree", "intersection agree"))
+    for size in sizes:
+        decisions, fps = results[size]
+        commands = sum(d[0] == r[0] for d, r in zip(decisions, reference)) / len(reference)
+        intersections = sum(d[1] == r[1] for d, r in zip(decisions, reference)) / len(reference)
+        print("{:>10} {:>8.1f} {:>8.1f}x {:>15.1%} {:>19.1%}".format(
+            "{}x{}".format(*size), fps, fps / ref_fps, commands, intersections))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# File:        ring_bench.py
+# Platform:    Python3.8+ (dev box or Rasbian)
+# Description: Reading frames from the frame ring vs. sending them through a pipe
+#
+# A forked writer publishes 640 x 480 frames with a result record at --fps,
+# like the nav process. The reader takes every new frame for --seconds, either
+# in place (view, then valid), as a copy (read) or pickled through an os.pipe
+# the way the driver would have to receive frames without shared memory.
+# Reports the reader's CPU time per frame and how old frames are when the
+# reader has them. Every frame is filled with its frame number, so a torn
+# frame that got past the seqlock would show.
+#
+# usage:
+#     ring_bench.py [--seconds 3.0] [--fps 30] [--slots 4]
+
+import os
+import time
+import pickle
+import argparse
+import numpy as np
+
+from frame_ring import FrameRing
+
+shape = (480, 640, 3)       # nav frame
+poll = 0.0005               # sec, ring reader sleep when there is no new frame (the driver waits in select)
+
+
+def frame(n):
+    return np.full(shape, n % 251, dtype=np.uint8)
+
+
+def paced(seconds, fps):
+    """ Frame numbers at fps for seconds """
+    start = time.monotonic()
+    n = 0
+    while time.monotonic() - start < seconds:
+        n += 1
+        yield n
+        time.sleep(max(0.0, start + n / fps - time.monotonic()))
+
+
+def publish(ring, seconds, fps):
+    for n in paced(seconds, fps):
+        ring.publish(frame(n), "<FWD>", n, lines=([0, 0, n % 640, 479], [], []), camera_seq=n)
+
+
+def pipe_writer(fd, seconds, fps):
+    f = os.fdopen(fd, 'wb')
+    try:
+        for n in paced(seconds, fps):
+            pickle.dump((frame(n), "<FWD>", n, [[0, 0, n % 640, 479]], time.monotonic_ns()), f)
+            f.flush()
+    except BrokenPipeError:     # the reader is done
+        pass
+
+
+def read_ring(ring, seconds, copy):
+    """ Returns (frames, reader CPU sec, total age in sec, retried, torn frames that got through) """
+    frames = retried = torn = 0
+    cpu = age = 0.0
+    last = 0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        start = time.process_time()
+        if ring.head() == last:
+            time.sleep(poll)
+            continue
+        if copy:
+            result = ring.read()
+            if result is None:
+                continue
+            n, image, record = result
+        else:
+            viewed = ring.view()
+            if viewed is None:
+                continue
+            n, image, record = viewed
+        ok = image[0, 0, 0] == image[-1, -1, -1] == record["camera_seq"] % 251
+        stamp = int(record["stamp"])
+        if not copy and not ring.valid(n):
+            retried += 1
+            continue
+        cpu += time.process_time() - start
+        age += (time.monotonic_ns() - stamp) / 1e9
+        torn += not ok
+        frames += 1
+        last = n
+    return frames, cpu, age, retried + ring.retries, torn
+
+
+def read_pipe(fd, seconds):
+    """ Returns (frames, reader CPU sec, total age in sec) """
+    f = os.fdopen(fd, 'rb')
+    frames = 0
+    cpu = age = 0.0
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        start = time.process_time()
+        try:
+            image, command, n, lines, stamp = pickle.load(f)
+        except EOFError:
+            break
+        cpu += time.process_time() - start
+        age += (time.monotonic_ns() - stamp) / 1e9
+        frames += 1
+    f.close()
+    return frames, cpu, age
+
+
+def report(name, frames, cpu, age, extra=""):
+    print("{:>15}: {:4d} frames, reader CPU {:7.1f} us/frame, {:6.2f} ms old when read{}".format(
+        name, frames, 1e6 * cpu / max(frames, 1), 1e3 * age / max(frames, 1), extra))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Frame ring vs. pipe")
+    parser.add_argument("--seconds", type=float, default=3.0, help="length of each run")
+    parser.add_argument("--fps", type=float, default=30.0, help="frames published per second")
+    parser.add_argument("--slots", type=int, default=4, help="slots in the ring")
+    args = parser.parse_args()
+
+    print("{}x{} frames at {} fps for {} s".format(shape[1], shape[0], args.fps, args.seconds))
+    for name, copy in [("ring, in place", False), ("ring, copied", True)]:
+        ring = FrameRing.create("clade_bench", shape, args.slots)
+        pid = os.fork()
+        if pid == 0:
+            publish(ring, args.seconds + 0.5, args.fps)
+            os._exit(0)
+        frames, cpu, age, retried, torn = read_ring(ring, args.seconds, copy)
+        os.waitpid(pid, 0)
+        ring.close()
+        report(name, frames, cpu, age, ", {} reads retried, {} torn".format(retried, torn))
+
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        pipe_writer(w, args.seconds + 0.5, args.fps)
+        os._exit(0)
+    os.close(w)
+    frames, cpu, age = read_pipe(r, args.seconds)
+    os.waitpid(pid, 0)
+    report("pickled, pipe", frames, cpu, age)
+
+
+if __name__ == "__main__":
+    main()
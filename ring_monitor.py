@@ -0,0 +1,61 @@
+# File:        ring_monitor.py
+# Platform:    Rasbian with Python3.8+
+# Description: Watch the frames and results the nav and targeting processes publish
+#
+# Attaches to the frame rings the driver creates (frame_ring.py) while the
+# robot is running and prints the newest record of each ring: frame rate,
+# age, last command, lane lines and blobs.
+# Records are read in place; the monitor never slows down the publishers.
+#
+# usage:
+#     ring_monitor.py [--rings nav target] [--every 1.0] [--show]
+
+import time
+import argparse
+import cv2
+
+import frame_ring
+
+ring_prefix = "clade_"     # same as driver.ring_prefix
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch the nav and targeting frame rings")
+    parser.add_argument("--rings", nargs="+", default=["nav", "target"], help="sources to watch")
+    parser.add_argument("--every", type=float, default=1.0, help="sec between printed lines")
+    parser.add_argument("--show", action="store_true", help="show the newest frame of each ring")
+    args = parser.parse_args()
+
+    rings = {source: frame_ring.FrameRing.attach(ring_prefix + source) for source in args.rings}
+    last = {source: (ring.head(), time.monotonic()) for source, ring in rings.items()}
+    try:
+        while True:
+            time.sleep(args.every if not args.show else 0.03)
+            for source, ring in rings.items():
+                viewed = ring.view()
+                if viewed is None:
+                    continue
+                n, frame, record = viewed
+                if args.show:
+                    cv2.imshow(source, frame)
+                last_n, last_time = last[source]
+                if time.monotonic() - last_time < args.every:
+                    continue
+                line = "{:>6}: frame {:6d}, {:5.1f} fps, {:.1f} ms old, command {}, lines {}, blobs {}".format(
+                    source, n, (n - last_n) / (time.monotonic() - last_time),
+                    (time.monotonic_ns() - int(record["stamp"])) / 1e6, frame_ring.command(record),
+                    {name: line.tolist() for name, line in frame_ring.lines(record).items()},
+                    frame_ring.blobs(record)[:, :4].astype(int).tolist())
+                if ring.valid(n):  # otherwise the publisher overwrote the slot while it was read
+                    print(line)
+                    last[source] = (n, time.monotonic())
+            if args.show and cv2.waitKey(1) == ord('q'):
+                break
+    except KeyboardInterrupt:
+        pass
+    for ring in rings.values():
+        ring.close()
+
+
+if __name__ == "__main__":
+    main()
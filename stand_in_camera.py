@@ -0,0 +1,100 @@
+# File:        stand_in_camera.py
+# Platform:    Python3 (dev box or Rasbian Buster)
+# Description: Stand-in for the Luxonis camera pipeline
+#
+# StandInPipeline has the two packet methods targeting.py uses on the
+# pipeline from camera_init() (get_available_data_packets and
+# get_available_nnet_and_data_packets) and plays recorded BGR frames as
+# previewout packets at the camera frame rate. A detect function can supply
+# the person boxes for each frame, which are sent as MobileNet-SSD metaout
+# packets, and a depth function the depth for each frame, sent as depth_sipp
+# packets. Packet data is laid out like the device sends it: previewout is
+# planar [Channel, Height, Width] and upside down, detection coordinates are
+# 0..1 in the upside down image, depth is uint16 mm and upside down.
+#
+# usage:
+#     pipeline = StandInPipeline(frames, detect=lambda frame: [(left, top, right, bottom), ...])
+#     targeting.target(sys.stdout, pipeline)
+
+import time
+import numpy as np
+
+person = 15     # MobileNet-SSD (VOC) label of a person
+
+
+class StandInPacket(object):
+    """ A data packet (previewout) """
+
+    def __init__(self, stream_name, data):
+        self.stream_name = stream_name
+        self.data = data
+
+    def getData(self):
+        return self.data
+
+
+class StandInNNetPacket(object):
+    """ A neural network packet with MobileNet-SSD detections """
+
+    def __init__(self, detections):
+        self.detections = detections    # list of dicts like the device entries
+
+    def entries(self):
+        # the device ends the detections with an entry with id -1
+        end = {"id": -1.0, "label": 0, "confidence": 0.0, "left": 0, "top": 0, "right": 0, "bottom": 0}
+        return [[detection] for detection in self.detections] + [[end]]
+
+
+def to_previewout(frame):
+    """ BGR frame -> planar, upside down previewout data """
+    return np.ascontiguousarray(frame[::-1].transpose(2, 0, 1))
+
+
+def to_detection(box, shape, label=person, confidence=1.0):
+    """ (left, top, right, bottom) pixel box in a BGR frame -> detection entry in upside down 0..1 coordinates """
+    height, width = shape[:2]
+    left, top, right, bottom = box
+    return {"id": 0.0, "label": label, "confidence": confidence,
+            "left": left / width, "top": 1 - bottom / height, "right": right / width, "bottom": 1 - top / height}
+
+
+class StandInPipeline(object):
+
+    def __init__(self, frames, fps=12.0, detect=None, depth=None, loop=True):
+        self.frames = frames        # BGR frames to play
+        self.fps = fps              # frames per second, like max_fps in camera_init
+        self.detect = detect        # function(frame) -> list of person boxes, None for no metaout stream
+        self.depth = depth          # function(frame) -> depth in mm (uint16 image), None for no depth stream
+        self.loop = loop            # start over after the last frame
+        self.sent = 0               # frames sent
+        self.start = None
+
+    def _due(self):
+        # frames the camera would have sent by now
+        if self.start is None:
+            self.start = time.monotonic()
+        due = int((time.monotonic() - self.start) * self.fps) + 1
+        if not self.loop:
+            due = min(due, len(self.frames))
+        frames = [self.frames[i % len(self.frames)] for i in range(self.sent, due)]
+        self.sent = max(self.sent, due)
+        return frames
+
+    def _data_packets(self, frames):
+        packets = []
+        for frame in frames:
+            packets.append(StandInPacket("previewout", to_previewout(frame)))
+            if self.depth is not None:
+                packets.append(StandInPacket("depth_sipp", np.ascontiguousarray(self.depth(frame)[::-1])))
+        return packets
+
+    def get_available_data_packets(self):
+        return self._data_packets(self._due())
+
+    def get_available_nnet_and_data_packets(self):
+        frames = self._due()
+        nnet_packets = []
+        if self.detect is not None:
+            nnet_packets = [StandInNNetPacket([to_detection(box, frame.shape) for box in self.detect(frame)])
+                            for frame in frames]
+        return nnet_packets, self._data_packets(frames)
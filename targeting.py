@@ -16,7 +16,9 @@
 # The Luxonis camera outputs data at a constant FPS (currently set to 12), and
 # will fill the data buffer and crash if the data is not read fast enough. Much
 # of the targeting design focuses on reading from this buffer constantly, even
-# if the data will not be used.
+# if the data will not be used. The buffer is read by a PacketReader thread
+# (packet_reader.py), which only keeps the newest frame, so image processing
+# can take as long as it needs.
 
 # --------------------------
 # IMPORTS
@@ -25,12 +27,17 @@
 import sys
 import cv2
 import time
-import imutils
 import numpy as np
 from datetime import datetime
 
-import luxonis_resources.depthai as depthai
-from camera_init import camera_init 
+import message
+from packet_reader import PacketReader
+
+try:
+    import luxonis_resources.depthai as depthai
+    from camera_init import camera_init
+except ImportError:     # no depthai library (e.g. benchmarking on a dev box)
+    depthai = camera_init = None
 
 # --------------------------
 # GLOBALS
@@ -39,6 +46,7 @@ from camera_init import camera_init
 # constants
 cmd_delay = 0        # sec, delay before processing next image when aiming
 fire_delay = 3       # sec, delay before processing next image after shooting
+settle_time = 0.5    # sec, target must stay aligned this long before shooting
 target_persist = 1.5 # sec, how long that seeing a target "persists"
 cmd_timeout = 0      # sec, how long to send continuous cmd after first issue
 
@@ -56,6 +64,14 @@ lower_red1 = np.array([0, 100, 120], dtype=int)
 upper_red1 = np.array([10, 255, 255], dtype=int)
 lower_red2 = np.array([170, 100, 120], dtype=int)
 upper_red2 = np.array([180, 255, 255], dtype=int)
+red_lut = None          # array, red_grey() of every 24 bit BGR color (see red_lookup_table)
+red_lut_thresholds = [] # list, red thresholds red_lut was built for
+
+# blob cleanup after red segmentation, see cleanup_methods
+cleanup = "box"         # name of the cleanup method, can be changed at runtime
+cleanup_size = 25       # kernel size for cleanup (must be odd, larger = more processing)
+cleanup_scale = 4       # downsampling factor for the "morph" cleanup
+grey_threshold = 30     # cleaned up grey value above which a pixel is part of a blob
 
 # targeting callibration
 target_threshold = 3000 # red area threshold to determine valid target
@@ -64,32 +80,103 @@ tolY = 10               # tolerance for y "center" of image, in pixels
 offsetX = 22            # x-offset of center of image, in pixels
 offsetY = 35            # y-offset of center of image, in pixels
 
+# tracking mode: once a target is found, only a window around it is processed
+track_margin = 30       # px, space searched around the last target's bounding box
+track_grow = 2          # the margin is multiplied by this for every frame the target is missed
+
+# neural network gating: red blobs are only searched for inside the person
+# boxes found by the MobileNet-SSD network on the camera (metaout stream)
+nn_gating = True        # bool, use the detections when the camera sends them
+detection_labels = [15] # list, MobileNet-SSD labels to search in (15 = person)
+detection_confidence = 0.5 # detections below this confidence are ignored
+detection_margin = 10   # px, added around each detection box
+detection_max_age = 0.5 # sec, detections and depth frames older than this are not used
+
+# depth gating: with the depth stream, blobs are filtered by their physical
+# size and range (from the stereo depth) instead of target_threshold. Off
+# until the stereo cameras are calibrated (calibration_file in camera_init)
+depth_gating = False    # bool, stream depth from the camera and use it
+depth_stream = 'depth_sipp' # depth stream from camera_init, uint16 in mm
+depth_flip = True       # bool, depth frames are upside down like previewout
+preview_fov = 69.0      # deg, horizontal field of view of the preview (left_fov_deg in camera_init)
+target_min_area = 100   # cm^2, smallest target
+target_max_area = 2500  # cm^2, largest target
+max_range = 300         # cm, targets further away are not engaged
+
+# multi-target mode: all targets in view are engaged one after the other,
+# nearest to the aim point first, without homing in between. Off until
+# targeting_replay.py shows a consistent gain over engaging the largest target
+multi_target = False    # bool, false to only engage the largest target
+switch_misses = 3       # frames, in multi-target mode a target not hit must be missing this many frames in a row before the next one is picked
+
 # variables
 global target_write     # object, to write commands to
-camera = camera_init()  # object, Luxonis camera
+camera = None           # object, Luxonis camera pipeline (from camera_init)
+reader = None           # object, PacketReader draining the camera in the background
+frame_seq = 0           # value, sequence number of the last previewout packet processed
 target_last_seen = 0    # time, when target was last seen
-fire_wait_start = 0     # time, wait start after firing
+aim_state = "aim"       # value, "aim", "settle" or "cooldown" (see fire_control)
+aim_state_start = 0     # time, when aim_state was entered
+engagement_start = None # time, target first seen, None if not engaging a target
+first_shot = None       # time, first shot of the current engagement
+shots = 0               # value, shots fired in the current engagement
+engagements = []        # list, (time to fire in sec or None, shots) of each engagement
 cmd_wait_start = 0      # time, wait start after sending command
 cmd_start = 0           # time, first continuous command sent
 last_cmd = home         # value, last command that was sent
 sending_cmd = False     # bool, true if currently sending a continuous cmd
+msg_seq = 0             # value, sequence number of the last message sent to the driver
+last_sent = None        # value, last command sent to the driver
+ring = None             # object, frame_ring.FrameRing frames and targets are published to, None to not publish
+frame_targets = np.zeros((0, 5)) # array, stats [x, y, w, h, area] of the targets in the last frame
+track_box = None        # array, [x, y, width, height] of the last target, None when acquiring
+track_misses = 0        # value, frames in a row the tracked target was not found
+scene_start = None      # time, first target of the scene seen, None if no targets seen
+scene_engagements = 0   # value, len(engagements) when the scene started
+scenes = []             # list, (time to clear in sec, engagements) of each scene
 
 
 # --------------------------
 # SUBSYSTEM FUNCTIONS
 # --------------------------
 
-def target(target_write_input):
-    global target_write, sending_cmd
+def target(target_write_input, pipeline=None, ring_input=None):
+    global target_write, sending_cmd, camera, reader, frame_seq, track_box, ring
     
     # global writer initialization
     target_write = target_write_input
+    ring = ring_input
+
+    # camera initialization (driver.py passes in the pipeline it created)
+    if pipeline is not None:
+        camera = pipeline
+    elif camera is None:
+        camera = camera_init(depth_gating)
+
+    # the reader thread keeps draining the camera, also between calls
+    if reader is None or reader.pipeline is not camera or not reader.running():
+        if reader is not None:
+            reader.stop()
+        nnet = nn_gating and hasattr(camera, 'get_available_nnet_and_data_packets')
+        reader = PacketReader(camera, nnet).start()
+
+    # build the red lookup table before the first frame
+    red_lookup_table()
+
+    # start with full frame acquisition
+    track_box = None
 
     is_aiming = True
     while is_aiming:
 
-        # get camera data
-        data_packets = camera.get_available_data_packets()
+        # wait for the next preview frame (packets are read by the reader thread)
+        packet, frame_time, seq = reader.read('previewout', after_seq=frame_seq)
+        if packet is None:
+            if not reader.running():
+                print("Camera packet reader stopped: {}".format(reader.error))
+                break
+            continue
+        frame_seq = seq
 
         # continous command timer (currently not sending continuous)
         if sending_cmd and time_since(cmd_start) < cmd_timeout:
@@ -99,25 +186,43 @@ def target(target_write_input):
             sending_cmd = False
         
         # image processing
-        for packet in data_packets:
-            if packet.stream_name == 'previewout':
-                data = packet.getData() # [Height, Width, Channel]
-                data0 = data[0,:,:]
-                data1 = data[1,:,:]
-                data2 = data[2,:,:]
-                frame_bgr = cv2.merge([data0, data1, data2])
-                frame_bgr = cv2.flip(frame_bgr, 0)
-                processed_frame, is_aiming = process_image(frame_bgr)
-                #cv2.imshow("targeting", processed_frame)
-                break
+        start = time.perf_counter()
+        frame_bgr = previewout_to_bgr(packet.getData())
+        detections = None
+        if reader.nnet:
+            meta, meta_time, _ = reader.read('metaout')
+            if meta is not None and abs(frame_time - meta_time) < detection_max_age:
+                detections = get_detections(meta, frame_bgr.shape)
+        depth = None
+        if depth_gating:
+            depth_packet, depth_time, _ = reader.read(depth_stream)
+            if depth_packet is not None and abs(frame_time - depth_time) < detection_max_age:
+                depth = depth_packet.getData()
+        mode = "full" if track_box is None else "track"
+        if detections is not None:
+            mode += ", {} detections".format(len(detections))
+        if depth is not None:
+            mode += ", depth"
+        processed_frame, is_aiming = process_image(frame_bgr, detections, depth)
+        if ring is not None: # share the frame and targets (zero-copy for readers)
+            ring.publish(processed_frame, last_sent, msg_seq, blobs=frame_targets, frame_time=frame_time,
+                         camera_seq=frame_seq)
+        print("Aiming iteration: {:.1f} ms ({}), {} preview frames dropped".format(
+            1e3 * (time.perf_counter() - start), mode, reader.dropped.get('previewout', 0)))
+        #cv2.imshow("targeting", processed_frame)
         
         if cv2.waitKey(1) == ord('q'):
             break
 
 
 def send_msg(command, start_continuous=False):
-    global cmd_wait_start, cmd_start, last_cmd, sending_cmd
+    global cmd_wait_start, cmd_start, last_cmd, sending_cmd, msg_seq, last_sent
     
+    # not a driver command, drop it instead of crashing targeting
+    if command not in message.opcodes:
+        print("Invalid command not sent: {}".format(command))
+        return
+
     # command wait timer
     if time_since(cmd_wait_start) < cmd_delay: # currently not used
         return
@@ -127,7 +232,11 @@ def send_msg(command, start_continuous=False):
         print(command)
     else:
         print(command)
-        target_write.write(command.encode('utf-8'))
+        msg_seq += 1
+        target_write.write(message.encode(command, msg_seq))
+        target_write.flush()
+
+    last_sent = command
 
     # start cmd wait timer
     cmd_wait_start = NOW()
@@ -140,8 +249,8 @@ def send_msg(command, start_continuous=False):
 
 
 def command_from_target_location(dx, dy):
-    global fire_wait_start
     fire_ready = False # bool, true if aligned horizontally
+    aligned = False    # bool, true if aligned on both axes
 
     # status log
     print("Found target at ({}, {}), shooting at ({}+-{}, {}+-{})"
@@ -164,23 +273,73 @@ def command_from_target_location(dx, dy):
     elif dy - offsetY < -tolY:
         #print("up")
         send_msg(up, True)
-    elif fire_ready:
-        time.sleep(.5)
-        #print("firing")
-        if time_since(fire_wait_start) < fire_delay:
+    else:
+        aligned = fire_ready
+
+    fire_control(aligned)
+
+
+def fire_control(aligned):
+    global aim_state, aim_state_start, engagement_start, first_shot, shots
+
+    # Called for every frame with a target, never waits. States:
+    #   aim      - moving onto the target
+    #   settle   - aligned, waiting settle_time for the turret to stop moving
+    #   cooldown - fired, waiting fire_delay for the target to fall
+    now = NOW()
+    if engagement_start is None:
+        engagement_start = now
+        first_shot = None
+        shots = 0
+
+    if aim_state == "cooldown":
+        if now - aim_state_start < fire_delay:
             return
+        aim_state, aim_state_start = "aim", now
+
+    if not aligned:
+        if aim_state != "aim":
+            aim_state, aim_state_start = "aim", now
+    elif aim_state == "aim":
+        aim_state, aim_state_start = "settle", now
+    elif now - aim_state_start >= settle_time:
+        #print("firing")
         send_msg(fire)
-        fire_wait_start = NOW() # wait after firing for target to fall
+        shots += 1
+        if first_shot is None:
+            first_shot = now
+        aim_state, aim_state_start = "cooldown", now # wait after firing for target to fall
+
+
+def end_engagement():
+    global aim_state, engagement_start
+
+    # report the engagement once the target is gone
+    if engagement_start is None:
+        return
+    time_to_fire = first_shot - engagement_start if first_shot is not None else None
+    engagements.append((time_to_fire, shots))
+    print("Engagement over: {} shot(s), time to fire {}".format(
+        shots, "{:.2f} s".format(time_to_fire) if time_to_fire is not None else "-"))
+    engagement_start = None
+    if aim_state != "cooldown":
+        aim_state = "aim"
 
 
 # --------------------------
 # IMAGE PROCESSING FUNCTIONS
 # --------------------------
 
-def get_contours(frame):
+def previewout_to_bgr(data):
     
-    # kernel size for img processing (must be odd, larger = more processing)
-    kernel_size = 25
+    # previewout data is planar [Channel, Height, Width] and upside down. Interleave
+    # the planes into one new image (the only copy) and flip that image in place
+    frame_bgr = cv2.merge([data[0], data[1], data[2]])
+    cv2.flip(frame_bgr, 0, dst=frame_bgr)
+    return frame_bgr
+
+
+def red_grey(frame):
 
     # Convert image to grayscale and HSV
     grey_img = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
@@ -191,23 +350,219 @@ def get_contours(frame):
     mask_red2 = cv2.inRange(hsv_img, lower_red2, upper_red2)
     mask_red = cv2.bitwise_or(mask_red1, mask_red2)
 
-    # apply the mask and a threshold
-    processed = cv2.bitwise_and(grey_img, mask_red)
-    processed = cv2.GaussianBlur(processed, (kernel_size, kernel_size), 0)
-    processed = cv2.threshold(processed, 30, 255, cv2.THRESH_BINARY)[1]
-    
-    # find contours
-    contours = cv2.findContours(processed.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    contours = imutils.grab_contours(contours)
-    return contours
+    # apply the mask (grey value of red pixels, 0 everywhere else)
+    return cv2.bitwise_and(grey_img, mask_red)
 
 
-def draw_contours(frame, contour):
+def red_lookup_table():
+    global red_lut, red_lut_thresholds
+
+    # red_grey() only looks at one pixel at a time, so its result for every
+    # possible color can be stored in a table indexed by B + G<<8 + R<<16. The
+    # table is rebuilt (about 0.1 s) whenever the red thresholds change,
+    # one R value (a 256 x 256 image of all G, B) at a time so the 16 MB table
+    # is the only large array
+    thresholds = [lower_red1.tolist(), upper_red1.tolist(), lower_red2.tolist(), upper_red2.tolist()]
+    if red_lut is None or thresholds != red_lut_thresholds:
+        lut = np.empty((256, 256, 256), dtype=np.uint8)
+        colors = np.empty((256, 256, 3), dtype=np.uint8)
+        colors[:, :, 0] = np.arange(256)                # B
+        colors[:, :, 1] = np.arange(256)[:, None]       # G
+        for r in range(256):
+            colors[:, :, 2] = r
+            lut[r] = red_grey(colors)
+        red_lut = lut.reshape(-1)
+        red_lut_thresholds = thresholds
+    return red_lut
+
+
+def red_lookup(frame):
+
+    # same result as red_grey(frame), with one table lookup per pixel
+    lut = red_lookup_table()
+    bgra = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+    index = bgra.view('<u4')[:, :, 0] & 0xFFFFFF
+    return np.take(lut, index)
+
+
+def cleanup_gaussian(processed):
+
+    # blur and threshold (the original cleanup)
+    processed = cv2.GaussianBlur(processed, (cleanup_size, cleanup_size), 0)
+    return cv2.threshold(processed, grey_threshold, 255, cv2.THRESH_BINARY)[1]
+
+
+def cleanup_box(processed):
+
+    # separable box filter (running sums, cost does not grow with the kernel size)
+    processed = cv2.blur(processed, (cleanup_size, cleanup_size))
+    return cv2.threshold(processed, grey_threshold, 255, cv2.THRESH_BINARY)[1]
+
+
+def cleanup_integral(processed):
+
+    # box filter from the integral image of the padded frame, same result as
+    # cleanup_box. The mean of the box is rounded like cv2.blur, so it is above
+    # the threshold when 2 * sum >= (2 * grey_threshold + 1) * area
+    r = cleanup_size // 2
+    padded = cv2.copyMakeBorder(processed, r, r, r, r, cv2.BORDER_REFLECT_101)
+    sums = cv2.integral(padded)
+    k = cleanup_size
+    box = sums[k:, k:] - sums[:-k, k:] - sums[k:, :-k] + sums[:-k, :-k]
+    return np.where(2 * box >= (2 * grey_threshold + 1) * k * k, 255, 0).astype(np.uint8)
+
+
+def cleanup_morph(processed):
+
+    # threshold a downsampled frame, remove specks and fill holes with an
+    # open and close, then scale the mask back up
+    height, width = processed.shape[:2]
+    small = cv2.resize(processed, (width // cleanup_scale, height // cleanup_scale), interpolation=cv2.INTER_AREA)
+    small = cv2.threshold(small, grey_threshold, 255, cv2.THRESH_BINARY)[1]
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (3, 3))
+    small = cv2.morphologyEx(small, cv2.MORPH_OPEN, kernel)
+    small = cv2.morphologyEx(small, cv2.MORPH_CLOSE, kernel)
+    return cv2.resize(small, (width, height), interpolation=cv2.INTER_NEAREST)
+
+
+# cleanup methods by name (set cleanup to one of these), see targeting_bench.py
+cleanup_methods = {
+    "gaussian": cleanup_gaussian,
+    "box": cleanup_box,
+    "integral": cleanup_integral,
+    "morph": cleanup_morph,
+}
+
+
+def tracking_window(frame):
+
+    # the whole frame when acquiring a target. When tracking, the last target's
+    # bounding box plus a margin that grows for every frame the target is missed
+    if track_box is None:
+        return frame, (0, 0)
+    height, width = frame.shape[:2]
+    margin = track_margin * track_grow ** track_misses
+    x, y, w, h = track_box
+    x0 = int(max(x - margin, 0))
+    y0 = int(max(y - margin, 0))
+    x1 = int(min(x + w + margin, width))
+    y1 = int(min(y + h + margin, height))
+    return frame[y0:y1, x0:x1], (x0, y0)
+
+
+def get_detections(packet, shape):
+
+    # bounding boxes (left, top, right, bottom) in pixels of the detections
+    # of interest in a metaout packet. The network sees the upside down
+    # preview, so top and bottom are flipped like the frame
+    height, width = shape[:2]
+    boxes = []
+    for entry in packet.entries():
+        e = entry[0]
+        if e['id'] == -1.0 or e['confidence'] == 0.0:
+            break # end of the detections
+        if e['label'] in detection_labels and e['confidence'] >= detection_confidence:
+            boxes.append((e['left'] * width, (1 - e['bottom']) * height,
+                          e['right'] * width, (1 - e['top']) * height))
+    return boxes
+
+
+def search_windows(frame, detections=None):
+
+    # the window to search (whole frame or tracking window), and when there
+    # are detections only the parts of it inside the detection boxes. Returns
+    # a list of (window, offset of the window in the frame)
+    window, (x0, y0) = tracking_window(frame)
+    if detections is None:
+        return [(window, (x0, y0))]
+    height, width = window.shape[:2]
+    windows = []
+    for left, top, right, bottom in detections:
+        l = int(max(left - detection_margin - x0, 0))
+        t = int(max(top - detection_margin - y0, 0))
+        r = int(min(right + detection_margin - x0, width))
+        b = int(min(bottom + detection_margin - y0, height))
+        if r > l and b > t:
+            windows.append((window[t:b, l:r], (x0 + l, y0 + t)))
+    return windows
+
+
+def get_blobs(frame, offset=(0, 0)):
+
+    # grey value of the red pixels, then clean up into a binary mask
+    processed = red_lookup(frame)
+    processed = cleanup_methods[cleanup](processed)
+    return blob_stats(processed, offset)
+
+
+def blob_stats(mask, offset=(0, 0)):
+
+    # find the outline of each blob (findContours leaves the mask alone)
+    contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+    # one row of stats (x, y, width, height, area, columns as in
+    # cv2.connectedComponentsWithStats) and one centroid (x, y) per blob
+    stats = np.zeros((len(contours), 5))
+    centroids = np.zeros((len(contours), 2))
+    for i, contour in enumerate(contours):
+        M = cv2.moments(contour)
+        stats[i, :4] = cv2.boundingRect(contour)
+        stats[i, cv2.CC_STAT_AREA] = M["m00"]
+        if M["m00"] > 0:
+            centroids[i] = M["m10"] / M["m00"], M["m01"] / M["m00"]
+        else: # a line or a single pixel, use the center of the bounding box
+            centroids[i] = stats[i, 0] + stats[i, 2] / 2, stats[i, 1] + stats[i, 3] / 2
+
+    # move blobs found in a window to frame coordinates
+    stats[:, :2] += offset
+    centroids += offset
+    return stats, centroids
+
+
+def blob_ranges(stats, depth, shape):
+
+    # range in cm to each blob: median of the valid depth pixels in the middle
+    # half of its bounding box (the edges of the box are often background).
+    # The depth frame is scaled to the preview frame, so its position is
+    # approximate. NaN if there is no valid depth
+    height, width = shape[:2]
+    depth_height, depth_width = depth.shape[:2]
+    ranges = np.full(len(stats), np.nan)
+    for i, (x, y, w, h) in enumerate(stats[:, :4]):
+        left = int((x + w / 4) * depth_width / width)
+        right = int(np.ceil((x + 3 * w / 4) * depth_width / width))
+        top = (y + h / 4) / height
+        bottom = (y + 3 * h / 4) / height
+        if depth_flip:
+            top, bottom = 1 - bottom, 1 - top
+        top = int(top * depth_height)
+        bottom = int(np.ceil(bottom * depth_height))
+        values = depth[top:bottom, left:right]
+        values = values[values > 0]
+        if len(values):
+            ranges[i] = np.median(values) / 10
+    return ranges
+
+
+def size_filter(blobs, depth, shape):
+
+    # keep the blobs with a physical size and range that can be a target. A
+    # pixel at range r covers (r / focal length in pixels)^2 cm^2
+    stats, centroids = blobs
+    ranges = blob_ranges(stats, depth, shape)
+    focal = (shape[1] / 2) / np.tan(np.radians(preview_fov / 2))
+    with np.errstate(invalid='ignore'):
+        area = stats[:, cv2.CC_STAT_AREA] * (ranges / focal) ** 2
+        keep = (ranges <= max_range) & (area >= target_min_area) & (area <= target_max_area)
+    return stats[keep], centroids[keep]
+
+
+def draw_blob(frame, blob):
     
-    # compute the center of the contour
-    M = cv2.moments(contour)
-    cX = int(M["m10"] / M["m00"])
-    cY = int(M["m01"] / M["m00"])
+    # center of the blob
+    stats, centroid = blob
+    cX = int(centroid[0])
+    cY = int(centroid[1])
 
     # find image center
     processed_frame = frame
@@ -219,23 +574,26 @@ def draw_contours(frame, contour):
     dx = cX - x0
     dy = cY - y0
     
-    # draw the contour and center of the shape on the image
+    # draw the bounding box and center of the blob on the image
+    x, y, w, h = stats[:4]
     text = "Bad Guy: (" + str(dx) + "," + str(dy) + ")"
-    cv2.drawContours(processed_frame, [contour], -1, (0,255,0), 2)
+    cv2.rectangle(processed_frame, (int(x), int(y)), (int(x + w), int(y + h)), (0,255,0), 2)
     cv2.circle(processed_frame, (cX, cY), 7, (255, 255, 255), -1)
     cv2.putText(processed_frame, text, (cX - 75, cY - 20),
                 cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)   
     return processed_frame, dx, dy
 
 
-def get_largest_contour(contours):
-    if contours: # the list is not empty
-        largest_contour = max(contours, key = cv2.contourArea)
-        size = cv2.contourArea(largest_contour)
-    else: # the list is empty
-        largest_contour = None
+def get_largest_blob(blobs):
+    stats, centroids = blobs
+    if len(stats): # there is at least one blob
+        i = np.argmax(stats[:, cv2.CC_STAT_AREA])
+        largest_blob = (stats[i], centroids[i])
+        size = stats[i, cv2.CC_STAT_AREA]
+    else: # no blobs
+        largest_blob = None
         size = 0
-    return largest_contour, size
+    return largest_blob, size
 
 
 def draw_no_target(frame):
@@ -247,25 +605,89 @@ def draw_no_target(frame):
     return processed_frame
 
 
-def process_image(frame):
-    global target_last_seen
-    processed_frame = frame
-    
-    # get all red contours from the image
-    red_contours = get_contours(frame)
+def get_targets(frame, detections=None, depth=None):
+
+    # all red blobs in the image that can be targets (only around the target
+    # while tracking, only inside detection boxes if there are detections,
+    # nothing at all if the camera saw no one). With depth, blobs are
+    # filtered by physical size and range, otherwise by target_threshold
+    stats, centroids = [np.zeros((0, 5))], [np.zeros((0, 2))]
+    for window, offset in search_windows(frame, detections):
+        red_blobs = get_blobs(window, offset)
+        if depth is not None:
+            red_blobs = size_filter(red_blobs, depth, frame.shape)
+        else:
+            keep = red_blobs[0][:, cv2.CC_STAT_AREA] >= target_threshold
+            red_blobs = red_blobs[0][keep], red_blobs[1][keep]
+        stats.append(red_blobs[0])
+        centroids.append(red_blobs[1])
+    return np.concatenate(stats), np.concatenate(centroids)
 
-    # get the largest red contour
-    largest_contour, contour_size = get_largest_contour(red_contours)
 
-    # if the largest contour is small, assume no target has been found
-    if contour_size < target_threshold:
+def order_targets(targets, shape):
+
+    # targets ordered by how far the turret has to turn from its aim point
+    # (the image center plus offsetX, offsetY) to each of them
+    stats, centroids = targets
+    height, width = shape[:2]
+    focal = (width / 2) / np.tan(np.radians(preview_fov / 2))
+    angle_x = np.arctan((centroids[:, 0] - width / 2 - offsetX) / focal)
+    angle_y = np.arctan((centroids[:, 1] - height / 2 - offsetY) / focal)
+    order = np.argsort(np.hypot(angle_x, angle_y))
+    return stats[order], centroids[order]
+
+
+def end_scene():
+    global scene_start
+
+    # report how long it took to clear all targets in view
+    if scene_start is None:
+        return
+    scenes.append((NOW() - scene_start, len(engagements) - scene_engagements))
+    print("Scene clear: {} engagement(s) in {:.2f} s".format(scenes[-1][1], scenes[-1][0]))
+    scene_start = None
+
+
+def process_image(frame, detections=None, depth=None):
+    global target_last_seen, track_box, track_misses, scene_start, scene_engagements, frame_targets
+    processed_frame = frame
+    acquiring = track_box is None
+
+    # pick the target: the largest one, or in multi-target mode the one
+    # nearest to the aim point
+    targets = get_targets(frame, detections, depth)
+    frame_targets = targets[0]
+    target_blob = None
+    if multi_target:
+        stats, centroids = order_targets(targets, frame.shape)
+        if len(stats):
+            target_blob = (stats[0], centroids[0])
+    else:
+        target_blob, _ = get_largest_blob(targets)
+
+    # no target found
+    if target_blob is None:
         processed_frame = draw_no_target(frame)
+        track_misses += 1
+
+        # in multi-target mode, a tracked target that was shot at and is gone
+        # (or that has been missing switch_misses frames in a row, not just
+        # one blurred frame) is followed by a full frame search for the next
+        # target instead of waiting target_persist and homing
+        if multi_target and not acquiring and (shots > 0 or track_misses >= switch_misses):
+            end_engagement()
+            track_box = None
 
     # otherwise, assume a bad guy has been found
     else:
-        processed_frame, dx, dy  = draw_contours(frame, largest_contour)
+        processed_frame, dx, dy  = draw_blob(frame, target_blob)
         command_from_target_location(dx, dy)
         target_last_seen = NOW()
+        track_box = target_blob[0][:4].copy()
+        track_misses = 0
+        if scene_start is None:
+            scene_start = target_last_seen
+            scene_engagements = len(engagements)
 
     # If the target was seen recently, assume we still see the it (the camera
     # takes a sec to refocus when it moves). Otherwise, return turret to home
@@ -273,6 +695,9 @@ def process_image(frame):
     if time_since(target_last_seen) > target_persist:
         is_aiming = False
         send_msg(home)
+        track_box = None # back to full frame acquisition
+        end_engagement()
+        end_scene()
     
     return processed_frame, is_aiming
 
@@ -286,9 +711,9 @@ def time_since(given_time):
     return int(NOW() - given_time)
 
 
-# time right now
+# time right now (monotonic, only used for time differences)
 def NOW():
-    return time.time()
+    return time.monotonic()
 
 
 # print commands to console when debugging as standalone module
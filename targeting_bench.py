@@ -0,0 +1,257 @@
+# File:        targeting_bench.py
+# Platform:    Python3 (dev box or Rasbian Buster)
+# Description: Microbenchmarks for the targeting image processing
+#
+# Runs targeting.py processing steps on recorded frames (by default the
+# archive/cv_targeting input images, resized to the 300 x 300 previewout size)
+# without the Luxonis camera, and compares them against the previous way of
+# doing the same step.
+#
+# usage:
+#     targeting_bench.py [<benchmark> ...] [--frames <directory of .jpg frames>]
+# benchmarks: previewout, red, cleanup, blobs, tracking, gating, depth
+
+import io
+import os
+import sys
+import contextlib
+import glob
+import time
+import cv2
+import numpy as np
+
+import targeting
+import stand_in_camera
+
+default_frames = os.path.join(os.path.dirname(os.path.abspath(__file__)), "archive", "cv_targeting", "input_images")
+preview_size = (300, 300)   # previewout frame size (width, height)
+repeat = 200                # times each frame is processed per measurement
+
+
+def load_frames(directory=default_frames):
+    """ Recorded BGR frames, resized to the previewout size """
+    names = sorted(glob.glob(os.path.join(directory, "*.jpg")) + glob.glob(os.path.join(directory, "*.JPG")))
+    return [cv2.resize(cv2.imread(name), preview_size, interpolation=cv2.INTER_AREA) for name in names]
+
+
+def measure(fcn, inputs):
+    """ Mean time per call in microseconds """
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for value in inputs:
+            fcn(value)
+    return 1e6 * (time.perf_counter() - start) / (repeat * len(inputs))
+
+
+def report(name, old_us, new_us):
+    print("{:>24}: {:8.1f} us -> {:8.1f} us per frame ({:+.1f} us, {:.2f}x)".format(
+        name, old_us, new_us, new_us - old_us, old_us / new_us))
+
+
+# --------------------------
+# BENCHMARKS
+# --------------------------
+
+def bench_previewout(frames):
+    packets = [stand_in_camera.to_previewout(frame) for frame in frames]
+
+    def merge_and_flip(data):
+        frame_bgr = cv2.merge([data[0, :, :], data[1, :, :], data[2, :, :]])
+        return cv2.flip(frame_bgr, 0)
+
+    for data, frame in zip(packets, frames):
+        assert (targeting.previewout_to_bgr(data) == frame).all()
+        assert (merge_and_flip(data) == frame).all()
+    report("previewout_to_bgr", measure(merge_and_flip, packets), measure(targeting.previewout_to_bgr, packets))
+
+
+def bench_red(frames):
+    start = time.perf_counter()
+    targeting.red_lookup_table()
+    print("{:>24}: {:8.1f} ms".format("red_lookup_table build", 1e3 * (time.perf_counter() - start)))
+
+    for frame in frames:
+        assert (targeting.red_lookup(frame) == targeting.red_grey(frame)).all()
+    report("red_lookup", measure(targeting.red_grey, frames), measure(targeting.red_lookup, frames))
+
+
+def largest_blob(mask):
+    """ (area, centroid x, centroid y) of the largest blob in a binary mask, or None """
+    blob, size = targeting.get_largest_blob(targeting.blob_stats(mask))
+    if blob is None:
+        return None
+    return float(size), float(blob[1][0]), float(blob[1][1])
+
+
+def largest_contour(mask):
+    """ The same the previous way: copy, findContours, contourArea of every contour, then moments """
+    contours = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if not contours:
+        return None
+    contour = max(contours, key=cv2.contourArea)
+    M = cv2.moments(contour)
+    return float(cv2.contourArea(contour)), M["m10"] / M["m00"], M["m01"] / M["m00"]
+
+
+def largest_component(mask):
+    """ The same from cv2.connectedComponentsWithStats (counts pixels, so areas are a little larger) """
+    stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)[2:]
+    if len(stats) < 2:
+        return None
+    i = 1 + np.argmax(stats[1:, cv2.CC_STAT_AREA])
+    return float(stats[i, cv2.CC_STAT_AREA]), float(centroids[i][0]), float(centroids[i][1])
+
+
+def bench_cleanup(frames):
+    red = [targeting.red_lookup(frame) for frame in frames]
+    reference = targeting.cleanup_methods["gaussian"]
+    reference_us = measure(reference, red)
+    reference_blobs = [largest_blob(reference(processed)) for processed in red]
+
+    for name, fcn in targeting.cleanup_methods.items():
+        report("cleanup " + name, reference_us, measure(fcn, red))
+        # how far the largest blob moves compared to the gaussian cleanup
+        for i, processed in enumerate(red):
+            blob, ref = largest_blob(fcn(processed)), reference_blobs[i]
+            if blob is None or ref is None:
+                print("{:>24}  frame {}: blob {} (gaussian {})".format("", i, blob, ref))
+                continue
+            print("{:>24}  frame {}: area {:7.0f} (gaussian {:7.0f}), centroid moved {:5.2f} px{}".format(
+                "", i, blob[0], ref[0], np.hypot(blob[1] - ref[1], blob[2] - ref[2]),
+                "" if (blob[0] >= targeting.target_threshold) == (ref[0] >= targeting.target_threshold)
+                else ", TARGET DECISION DIFFERS"))
+
+
+def bench_blobs(frames):
+    masks = [targeting.cleanup_methods[targeting.cleanup](targeting.red_lookup(frame)) for frame in frames]
+    blob_us = measure(largest_blob, masks)
+    report("largest blob", measure(largest_contour, masks), blob_us)
+    report("connected components", measure(largest_component, masks), blob_us)
+    for i, mask in enumerate(masks):
+        assert largest_blob(mask) == largest_contour(mask)
+        print("{:>24}  frame {}: {} (connected components {})".format("", i, largest_blob(mask), largest_component(mask)))
+
+
+def moving_target(frame, steps=40, step=(2, 1)):
+    """ Frames with the content of frame moving step pixels per frame """
+    return [np.roll(frame, (i * step[1], i * step[0]), axis=(0, 1)) for i in range(steps)]
+
+
+def aim(frames, tracking, detections=None):
+    """ Run process_image on frames like target() does. Returns the time per iteration and the offsets aimed at """
+    aimed = []
+    targeting.command_from_target_location = lambda dx, dy: aimed.append((dx, dy))
+    targeting.track_box = None
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i, frame in enumerate(frames):
+            if not tracking:
+                targeting.track_box = None
+            frame = frame.copy()  # process_image draws on the frame
+            start = time.perf_counter()
+            targeting.process_image(frame, detections[i] if detections is not None else None)
+            times.append(time.perf_counter() - start)
+    return 1e6 * sum(times) / len(times), aimed
+
+
+def bench_tracking(frames):
+    command_from_target_location = targeting.command_from_target_location
+    targeting.target_write = io.BytesIO()
+    for i, frame in enumerate(frames):
+        blob, size = targeting.get_largest_blob(targeting.get_blobs(frame))
+        if size < targeting.target_threshold:
+            continue
+        sequence = moving_target(frame)
+        aim(sequence, False)    # warm up
+        full_us, full_aimed = aim(sequence, False)
+        track_us, track_aimed = aim(sequence, True)
+        report("tracking frame {}".format(i), full_us, track_us)
+        moved = [np.hypot(a[0] - b[0], a[1] - b[1]) for a, b in zip(full_aimed, track_aimed)]
+        print("{:>24}  aimed {} / {} times (full frame {}), max difference {:.1f} px".format(
+            "", len(track_aimed), len(sequence), len(full_aimed), max(moved) if moved else 0))
+    targeting.command_from_target_location = command_from_target_location
+
+
+def person_boxes(frame, margin=40):
+    """ Stand-in person detector: a box around the target, if there is one """
+    blob, size = targeting.get_largest_blob(targeting.get_blobs(frame))
+    if size < targeting.target_threshold:
+        return []
+    x, y, w, h = blob[0][:4]
+    return [(max(x - margin, 0), max(y - margin, 0), x + w + margin, y + h + margin)]
+
+
+def bench_gating(frames):
+    command_from_target_location = targeting.command_from_target_location
+    targeting.target_write = io.BytesIO()
+    # detections go through a metaout packet and get_detections like on the robot
+    packets = [stand_in_camera.StandInNNetPacket([stand_in_camera.to_detection(box, frame.shape)
+                                                  for box in person_boxes(frame)]) for frame in frames]
+    detections = [targeting.get_detections(packet, frame.shape) for packet, frame in zip(packets, frames)]
+    aim(frames, False)    # warm up
+    full_us, full_aimed = aim(frames, False)
+    gated_us, gated_aimed = aim(frames, False, detections)
+    report("gating", full_us, gated_us)
+    print("{:>24}  {} of {} frames with detections, aimed {} times (full frame {}), same offsets: {}".format(
+        "", sum(1 for d in detections if d), len(frames), len(gated_aimed), len(full_aimed), gated_aimed == full_aimed))
+    targeting.command_from_target_location = command_from_target_location
+
+
+def stand_in_depth(frame, target_range, depth_size=(320, 180)):
+    """ Stand-in depth frame (mm, upside down like the device): target_range cm inside the person boxes, no depth
+    elsewhere """
+    width, height = frame.shape[1], frame.shape[0]
+    depth = np.zeros(depth_size[::-1], dtype=np.uint16)
+    for left, top, right, bottom in person_boxes(frame):
+        depth[int(top * depth_size[1] / height):int(bottom * depth_size[1] / height),
+              int(left * depth_size[0] / width):int(right * depth_size[0] / width)] = target_range * 10
+    return np.ascontiguousarray(depth[::-1])
+
+
+def bench_depth(frames):
+    blobs = [targeting.get_blobs(frame) for frame in frames]
+    pixel_targets = sum(1 for b in blobs if targeting.get_largest_blob(b)[1] >= targeting.target_threshold)
+    print("{:>24}: {} of {} frames have a target by pixel area (target_threshold {})".format(
+        "depth", pixel_targets, len(frames), targeting.target_threshold))
+    for target_range in (50, 100, 200, 300, 400):
+        depths = [stand_in_depth(frame, target_range) for frame in frames]
+        start = time.perf_counter()
+        kept = [targeting.size_filter(b, depth, frame.shape) for b, depth, frame in zip(blobs, depths, frames)]
+        filter_us = 1e6 * (time.perf_counter() - start) / len(frames)
+        areas = ["{:.0f}".format(targeting.get_largest_blob(b)[1] * (target_range / (150 / np.tan(np.radians(
+            targeting.preview_fov / 2)))) ** 2) for b in blobs if len(b[0])]
+        print("{:>24}  at {:3d} cm: {} of {} frames have a target, largest blob areas {} cm^2, filter {:.1f} us".format(
+            "", target_range, sum(1 for k in kept if len(k[0])), len(frames), ", ".join(areas), filter_us))
+
+
+benchmarks = {
+    "previewout": bench_previewout,
+    "red": bench_red,
+    "cleanup": bench_cleanup,
+    "blobs": bench_blobs,
+    "tracking": bench_tracking,
+    "gating": bench_gating,
+    "depth": bench_depth,
+}
+
+
+def main():
+    args = sys.argv[1:]
+    directory = default_frames
+    if "--frames" in args:
+        i = args.index("--frames")
+        directory = args[i + 1]
+        del args[i:i + 2]
+    names = args if args else list(benchmarks)
+
+    frames = load_frames(directory)
+    if not frames:
+        print("No frames found in {}".format(directory))
+        sys.exit(1)
+    print("{} frames of {}x{}".format(len(frames), *preview_size))
+    for name in names:
+        benchmarks[name](frames)
+
+
+if __name__ == "__main__":
+    main()
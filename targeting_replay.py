@@ -0,0 +1,167 @@
+# File:        targeting_replay.py
+# Platform:    Python3 (dev box or Rasbian Buster)
+# Description: Run the targeting module against a simulated turret
+#
+# A scene with red targets (discs on a background image) is seen through a
+# 300 x 300 preview window that the turret commands move: <LFT>/<RGT> pan and
+# <UPP>/<DWN> tilt the window, <FIR> knocks down the target under the aim
+# point and <HOM> returns the window to its home position. Frames go through
+# targeting.process_image() at the camera frame rate on a virtual clock
+# (replay.VirtualClock), so settle_time, fire_delay and target_persist take as
+# many frames as on the robot. Reports the time to clear the scene, the shots
+# fired and how often the turret homed, with and without multi-target mode.
+#
+# usage:
+#     targeting_replay.py [--targets 3] [--seed 1] [--seeds 1] [--fps 12] [--mode single|multi|both]
+#                         [--background image]
+#
+# With --seeds N the scene is placed with seeds seed .. seed + N - 1 and a
+# summary per mode follows.
+
+import io
+import argparse
+import contextlib
+import cv2
+import numpy as np
+
+import message
+import targeting
+from replay import VirtualClock
+
+view_size = 300         # px, preview frame size
+scene_size = 700        # px, the scene is scene_size x scene_size
+home = (200, 200)       # top left corner of the preview window at the home position
+radius = 36             # px, target radius (area just over target_threshold)
+step = 3                # px, window movement per turret command
+max_time = 60           # sec, the replay stops after this long
+
+
+class Turret(object):
+    """ Stands in for the pipe to the driver: moves the preview window and knocks down targets """
+
+    def __init__(self, clock, targets):
+        self.clock = clock
+        self.targets = targets      # list of [x, y] target centers in scene pixels
+        self.x, self.y = home       # top left corner of the preview window
+        self.commands = {}          # command -> times sent
+        self.start = clock.time()
+        self.hits = []              # seconds from the start to each hit
+
+    def aim_point(self):
+        return (self.x + view_size / 2 + targeting.offsetX, self.y + view_size / 2 + targeting.offsetY)
+
+    def write(self, data):
+        command = message.decode(data).command
+        self.commands[command] = self.commands.get(command, 0) + 1
+        # targeting sends <LFT> when the target is right of the aim point, so <LFT> moves the window right
+        if command == targeting.left:
+            self.x = min(self.x + step, scene_size - view_size)
+        elif command == targeting.right:
+            self.x = max(self.x - step, 0)
+        elif command == targeting.down:
+            self.y = min(self.y + step, scene_size - view_size)
+        elif command == targeting.up:
+            self.y = max(self.y - step, 0)
+        elif command == targeting.home:
+            self.x, self.y = home
+        elif command == targeting.fire:
+            ax, ay = self.aim_point()
+            for target in self.targets:
+                if np.hypot(target[0] - ax, target[1] - ay) <= radius:
+                    self.targets.remove(target)
+                    self.hits.append(self.clock.time() - self.start)
+                    break
+
+    def flush(self):
+        pass
+
+    def view(self, background):
+        scene = background.copy()
+        for x, y in self.targets:
+            cv2.circle(scene, (int(x), int(y)), radius, (0, 0, 200), -1)
+        return scene[self.y:self.y + view_size, self.x:self.x + view_size]
+
+
+def place_targets(count, rng):
+    """ Target centers inside the home view, not overlapping """
+    targets = []
+    while len(targets) < count:
+        x, y = rng.uniform(home[0] + radius, home[0] + view_size - radius, 2)
+        if all(np.hypot(x - tx, y - ty) > 2.5 * radius for tx, ty in targets):
+            targets.append([x, y])
+    return targets
+
+
+def reset_targeting(multi):
+    """ Put the targeting state back to how it is when the module is loaded """
+    targeting.multi_target = multi
+    targeting.target_last_seen = 0
+    targeting.cmd_wait_start = targeting.cmd_start = 0
+    targeting.sending_cmd = False
+    targeting.aim_state, targeting.aim_state_start = "aim", 0
+    targeting.engagement_start = None
+    targeting.engagements = []
+    targeting.track_box = None
+    targeting.track_misses = 0
+    targeting.scene_start = None
+    targeting.scenes = []
+
+
+def run(targets, background, fps, multi):
+    clock = VirtualClock(start=1000.0)
+    targeting.time = clock
+    turret = Turret(clock, [list(t) for t in targets])
+    targeting.target_write = turret
+    reset_targeting(multi)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        while turret.targets and clock.time() - turret.start < max_time:
+            clock.advance(1.0 / fps)
+            targeting.process_image(turret.view(background))
+    return turret, clock.time() - turret.start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run targeting against a simulated turret")
+    parser.add_argument("--targets", type=int, default=3, help="number of targets in the scene")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the target positions")
+    parser.add_argument("--seeds", type=int, default=1, help="number of seeds to run, starting at --seed")
+    parser.add_argument("--fps", type=float, default=12.0, help="preview frame rate")
+    parser.add_argument("--mode", default="both", choices=["single", "multi", "both"])
+    parser.add_argument("--background", default=None, help="background image for the scene")
+    args = parser.parse_args()
+
+    if args.background is not None:
+        background = cv2.resize(cv2.imread(args.background), (scene_size, scene_size), interpolation=cv2.INTER_AREA)
+    else:
+        background = np.full((scene_size, scene_size, 3), 60, dtype=np.uint8)
+    targeting.red_lookup_table()
+
+    modes = {"single": [False], "multi": [True], "both": [False, True]}[args.mode]
+    totals = {multi: [0.0, 0, 0] for multi in modes}   # mode -> [seconds, HOM, targets not hit]
+    for seed in range(args.seed, args.seed + args.seeds):
+        targets = place_targets(args.targets, np.random.default_rng(seed))
+        if args.seeds > 1:
+            print("seed {}".format(seed))
+        for multi in modes:
+            turret, elapsed = run(targets, background, args.fps, multi)
+            cleared = len(turret.hits) == len(targets)
+            print("{:>6}: {} of {} targets hit, {} {:.2f} s, {} shots, {} HOM".format(
+                "multi" if multi else "single", len(turret.hits), len(targets),
+                "cleared in" if cleared else "gave up after", elapsed,
+                turret.commands.get(targeting.fire, 0), turret.commands.get(targeting.home, 0)))
+            if turret.hits:
+                print("        hits at {} s".format(", ".join("{:.2f}".format(t) for t in turret.hits)))
+            totals[multi][0] += elapsed
+            totals[multi][1] += turret.commands.get(targeting.home, 0)
+            totals[multi][2] += len(targets) - len(turret.hits)
+
+    if args.seeds > 1:
+        for multi in modes:
+            seconds, homes, missed = totals[multi]
+            print("{:>6} total: {:.2f} s, {} HOM, {} targets not hit over {} seeds".format(
+                "multi" if multi else "single", seconds, homes, missed, args.seeds))
+
+
+if __name__ == "__main__":
+    main()
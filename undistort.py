@@ -0,0 +1,129 @@
+# File:        undistort.py
+# Platform:    Rasbian Buster with Python3
+# Description: Lens undistortion for the Raspberry Pi navigation camera
+#
+# Building the undistortion maps (getOptimalNewCameraMatrix and
+# initUndistortRectifyMap) costs more than the rest of the lane pipeline, so
+# the maps are built once per (calibration, resolution) in the fixed-point
+# CV_16SC2 format, saved to disk next to this file, and memory-mapped on the
+# next start. Only the rows that the lane/intersection ROIs use need to be
+# remapped; rows above `first_row` are left black.
+
+# --------------------------
+# IMPORTS
+# --------------------------
+
+import os
+import cv2
+import hashlib
+import numpy as np
+from pathlib import Path
+
+
+# --------------------------
+# CALIBRATION
+# --------------------------
+
+# camera distortion corrections (from calibrate.py, taken at calib_size)
+camera_matrix = np.array([[243.48186479, 0., 305.08168044],
+                          [0., 244.0802712, 226.73721762],
+                          [0., 0., 1.]])
+
+dist_coeffs = np.array([-2.67227451e-01, 6.92939876e-02, 2.32058609e-03, 2.62454856e-05, -7.75020091e-03])
+
+calib_size = (640, 480)     # (width, height) the calibration images were taken at
+
+# maps are saved here, one pair of .npy files per (calibration, resolution)
+map_dir = str((Path(__file__).parent / 'undistort_maps').resolve())
+
+# maps already loaded by this process, keyed by map_key()
+_maps = {}
+
+
+# --------------------------
+# MAPS
+# --------------------------
+
+def map_key(size, k=camera_matrix, d=dist_coeffs):
+    """ Name identifying the maps for one calibration at one (width, height) """
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(k, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(d, dtype=np.float64).tobytes())
+    return "{}x{}_{}".format(size[0], size[1], digest.hexdigest()[:12])
+
+
+def scale_camera_matrix(k, size):
+    """ Rescale a camera matrix from calib_size to another resolution """
+    sx = size[0] / calib_size[0]
+    sy = size[1] / calib_size[1]
+    scaled = np.array(k, dtype=np.float64)
+    scaled[0, :] *= sx
+    scaled[1, :] *= sy
+    return scaled
+
+
+def build_maps(size, k=camera_matrix, d=dist_coeffs):
+    """ Compute fixed-point (CV_16SC2) undistortion maps for a (width, height) """
+    k = scale_camera_matrix(k, size)
+    new_camera_matrix, roi = cv2.getOptimalNewCameraMatrix(k, d, size, 0)
+    map1, map2 = cv2.initUndistortRectifyMap(k, d, None, new_camera_matrix, size, cv2.CV_16SC2)
+    return map1, map2
+
+
+def _save(path, array):
+    # write to a temporary file first so a half written map is never loaded
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, path)
+
+
+def get_maps(size, k=camera_matrix, d=dist_coeffs):
+    """ Return the undistortion maps for a (width, height), building and
+    saving them the first time and memory-mapping the saved copy after """
+    key = map_key(size, k, d)
+    if key in _maps:
+        return _maps[key]
+
+    path1 = os.path.join(map_dir, key + "_map1.npy")
+    path2 = os.path.join(map_dir, key + "_map2.npy")
+    try:
+        map1 = np.load(path1, mmap_mode='r')
+        map2 = np.load(path2, mmap_mode='r')
+        if map1.shape[:2] != (size[1], size[0]) or map2.shape != (size[1], size[0]):
+            raise ValueError("saved maps do not match {}".format(size))
+    except (OSError, ValueError):
+        map1, map2 = build_maps(size, k, d)
+        try:
+            os.makedirs(map_dir, exist_ok=True)
+            _save(path1, map1)
+            _save(path2, map2)
+        except OSError as e:
+            print("Could not save undistortion maps: {}".format(e))
+
+    _maps[key] = (map1, map2)
+    return map1, map2
+
+
+# --------------------------
+# REMAP
+# --------------------------
+
+def undistort(raw_frame, first_row=0, last_row=None, k=camera_matrix, d=dist_coeffs, dst=None):
+    """ Undistort a frame, only remapping rows first_row..last_row. The output
+    has the full frame size so downstream pixel coordinates do not change """
+    h, w = raw_frame.shape[:2]
+    map1, map2 = get_maps((w, h), k, d)
+
+    if last_row is None:
+        last_row = h
+    if dst is None or dst.shape != raw_frame.shape or dst.dtype != raw_frame.dtype:
+        dst = np.zeros_like(raw_frame)
+    elif first_row > 0:
+        dst[:first_row] = 0
+
+    cv2.remap(raw_frame, map1[first_row:last_row], map2[first_row:last_row], cv2.INTER_LINEAR,
+              dst=dst[first_row:last_row])
+    if last_row < h:
+        dst[last_row:] = 0
+    return dst